@@ -0,0 +1,253 @@
+"""
+Memory-aware batch size tuning of the unrolled solver.
+
+The memory of a training step (double backward through n_grad solver iterations) grows with the batch size,
+the patch size, dim_grad_solver, DimAE and n_grad, and n_grad changes during the training (iter_update).
+For every n_grad stage of the schedule, a few training steps are probed on synthetic batches of increasing
+size, a linear model of the peak memory in the batch size is fitted and the largest batch size within the budget
+is kept. BatchSizeSchedule switches the datamodule batch size when the training reaches a new stage.
+"""
+import copy
+import ctypes
+import gc
+import os
+import threading
+import time
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+
+def _release_memory(device):
+    # hand the memory freed by the previous probes back to the system so that they do not hide this one's peak
+    gc.collect()
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        return
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _rss():
+    # resident set size of the process in bytes
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class PeakMemory:
+    """
+    Context manager measuring the peak memory (bytes) of the enclosed code: memory allocated by torch on gpu,
+    resident set size of the process (sampled by a thread) on cpu
+    """
+
+    def __init__(self, device, interval=.002):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak = 0
+        self._stop = None
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self.peak = _rss()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, _rss())
+
+
+def device_memory(device):
+    """
+    :return: total memory of the device in bytes
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def synthetic_batch(model, batch_size, device, obs_rate=.1):
+    """
+    Random batch with the shapes of the model data: (oi, mask, gt) or (oi, mask, gt, sst) with SST
+    """
+    shape = (batch_size, model.hparams.dT) + tuple(model.hparams.shapeData[1:])
+    oi = torch.randn(shape, device=device)
+    mask = torch.rand(shape, device=device) < obs_rate
+    gt = oi + .1 * torch.randn(shape, device=device)
+    if model.model.model_H.DimObs > 1:
+        return oi, mask, gt, torch.randn(shape, device=device)
+    return oi, mask, gt
+
+
+def probe(model, batch_size, n_grad, device, steps=2):
+    """
+    Peak memory of training steps (loss, backward, optimizer step) of a copy of model
+    :return: peak memory in bytes
+    """
+    device = torch.device(device)
+    _release_memory(device)
+    model = copy.deepcopy(model).to(device)
+    model.train()
+    model.model.n_grad = n_grad
+    opt = model.configure_optimizers()
+    opt = opt[0] if isinstance(opt, (list, tuple)) else opt
+    batch = synthetic_batch(model, batch_size, device)
+    with PeakMemory(device) as mem:
+        for _ in range(steps):
+            loss, _, _ = model.compute_loss(batch, phase='train')
+            loss.backward()
+            opt.step()
+            opt.zero_grad()
+    del model, opt, batch, loss
+    _release_memory(device)
+    return mem.peak
+
+
+def n_grad_stages(hparams):
+    """
+    :return: {<first epoch of the stage>: n_grad} following LitModel.on_train_epoch_start
+    """
+    stages = {0: int(hparams.n_grad)}
+    for indx, epoch in enumerate(hparams.iter_update):
+        if epoch > 0:
+            stages[int(epoch)] = int(hparams.nb_grad_update[indx])
+    return stages
+
+
+def patch_size_stages(hparams):
+    """
+    :return: {<first epoch of the stage>: <training patch size>} of the iter_update stages from patch_size_update,
+        None without patch size curriculum
+    """
+    if not hparams.get('patch_size_update'):
+        return None
+    return {int(epoch): None if size is None else int(size)
+            for epoch, size in zip(hparams.iter_update, hparams.patch_size_update)}
+
+
+def tune(model, budget=None, device=None, probe_sizes=(1, 2, 4), margin=.1, max_batch_size=64, steps=2):
+    """
+    :param model: LitModel
+    :param budget: memory budget in bytes, the whole device memory by default
+    :param device: device of the training, cuda if available by default
+    :param probe_sizes: batch sizes probed for each n_grad
+    :param margin: fraction of the budget kept free (fragmentation, dataloader, logging)
+    :param max_batch_size: upper bound of the batch size
+    :param steps: training steps of each probe
+    :return: {'n_grad': {<n_grad>: {'peak': [<bytes>...], 'fit': [<bytes>, <bytes per patch>], 'batch_size': ...}},
+              'schedule': {<first epoch of the stage>: <batch size>}}
+    """
+    device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    budget = budget or device_memory(device)
+    usable = (1 - margin) * budget
+    stages = n_grad_stages(model.hparams)
+
+    res = {'budget': budget, 'device': str(device), 'n_grad': {}, 'schedule': {}}
+    for n_grad in sorted(set(stages.values())):
+        peaks = []
+        for bs in probe_sizes:
+            try:
+                peaks.append(probe(model, bs, n_grad, device, steps=steps))
+            except RuntimeError as e:
+                # out of memory: larger batch sizes will not fit either
+                if 'out of memory' not in str(e):
+                    raise
+                _release_memory(device)
+                break
+        sizes = probe_sizes[:len(peaks)]
+        if len(peaks) >= 2:
+            per_patch, base = np.polyfit(sizes, peaks, 1)
+            per_patch = max(per_patch, 1.)
+        elif peaks:
+            base, per_patch = 0., float(peaks[0]) / sizes[0]
+        else:
+            base, per_patch = float('inf'), float('inf')
+        batch_size = int(np.clip(np.floor((usable - base) / per_patch), 1, max_batch_size))
+        if base + per_patch > usable:
+            print('... n_grad=%d: even a batch of 1 is over the memory budget' % n_grad)
+        res['n_grad'][n_grad] = {'peak': [int(p) for p in peaks], 'fit': [float(base), float(per_patch)],
+                                 'batch_size': batch_size}
+        print('..... n_grad=%2d: %s MB for batch sizes %s -- %.0f MB + %.0f MB/patch -> batch size %d' % (
+            n_grad, [round(p / 2 ** 20) for p in peaks], list(sizes), base / 2 ** 20, per_patch / 2 ** 20, batch_size))
+    res['schedule'] = {epoch: res['n_grad'][n_grad]['batch_size'] for epoch, n_grad in stages.items()}
+    return res
+
+
+class BatchSizeSchedule(pl.Callback):
+    """
+    Switch the batch size of the datamodule when the training reaches the epochs of the schedule, and with a patch
+    size curriculum the size of the random crops of the training patches, the training batch size being scaled by the
+    ratio of the full and cropped patch areas to keep the memory of a step about constant
+    (needs the trainer to reload its dataloaders every epoch, reload_dataloaders_every_epoch=True)
+    """
+
+    def __init__(self, schedule, patch_sizes=None, max_batch_size=None):
+        """
+        :param schedule: {<epoch>: <batch size of the full patches from this epoch on>}
+        :param patch_sizes: (Optional) {<epoch>: <size (lat and lon) of the training patches from this epoch on,
+            None for the full patches>}, see FourDVarNetDataModule.set_patch_size
+        :param max_batch_size: (Optional) upper bound of the scaled batch sizes
+        """
+        self.schedule = {int(epoch): int(bs) for epoch, bs in schedule.items()}
+        self.patch_sizes = patch_sizes or {}
+        self.max_batch_size = max_batch_size
+
+    def batch_size(self, epoch):
+        return self.schedule[max(e for e in self.schedule if e <= epoch)]
+
+    def patch_size(self, epoch):
+        epochs = [e for e in self.patch_sizes if e <= epoch]
+        return self.patch_sizes[max(epochs)] if epochs else None
+
+    def apply(self, datamodule, epoch):
+        """
+        Set the batch size (and patch size) of epoch on the datamodule: the stage batch size for all the dataloaders,
+        scaled by the patch area for the training one only (the val and test patches are not cropped)
+        """
+        bs = self.batch_size(epoch)
+        patch_size = self.patch_size(epoch)
+        train_bs = None
+        if patch_size is not None:
+            full_area = datamodule.slice_win['lat'] * datamodule.slice_win['lon']
+            area = min(patch_size, datamodule.slice_win['lat']) * min(patch_size, datamodule.slice_win['lon'])
+            train_bs = int(bs * full_area / area)
+            if self.max_batch_size is not None:
+                train_bs = min(train_bs, self.max_batch_size)
+        if self.patch_sizes and datamodule.patch_size != patch_size:
+            print('... Patch size %s from epoch %d' % (patch_size or 'full', epoch))
+            datamodule.set_patch_size(patch_size)
+        if self.patch_sizes and datamodule.train_batch_size != train_bs:
+            if train_bs is not None:
+                print('... Training batch size %d from epoch %d' % (train_bs, epoch))
+            datamodule.set_train_batch_size(train_bs)
+        if datamodule.batch_size != bs:
+            print('... Batch size %d from epoch %d' % (bs, epoch))
+            datamodule.set_batch_size(bs)
+
+    def on_train_start(self, trainer, pl_module):
+        # resumed training: the dataloaders are reloaded at the start of the first epoch
+        self.apply(trainer.datamodule, trainer.current_epoch)
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        # before the reload of the next epoch dataloaders
+        self.apply(trainer.datamodule, trainer.current_epoch + 1)
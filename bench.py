@@ -0,0 +1,235 @@
+"""
+CPU benchmarks of the hot paths: dataset items, dataloader throughput, solver forward/backward,
+LitModel.compute_loss, spectral and metrics scoring, import time.
+Results are written to json, `compare` flags regressions against a stored baseline.
+
+usage:
+    python bench.py run --out=bench.json                       # on generated synthetic data
+    python bench.py run --data_dir=data/synthetic --out=bench.json
+    python bench.py compare bench.json baseline.json --tolerance=0.1
+"""
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+
+def timeit(fn, repeat=5, warmup=1):
+    """
+    :return: {'mean_s', 'std_s', 'min_s', 'repeat'} of the wall time of fn()
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {'mean_s': float(np.mean(times)), 'std_s': float(np.std(times)), 'min_s': float(np.min(times)),
+            'repeat': repeat}
+
+
+def _datamodule(data_dir, patch, num_workers=0, batch_size=2):
+    from new_dataloading import FourDVarNetDataModule
+    from synthetic_data import FILES
+
+    return FourDVarNetDataModule(
+        slice_win={'time': 5, 'lat': patch, 'lon': patch},
+        dim_range={'lat': slice(33, 43), 'lon': slice(-65, -55)},
+        strides={'time': 1, 'lat': patch, 'lon': patch},
+        train_slices=(slice('2012-10-01', '2012-10-20'),),
+        val_slices=(slice('2012-10-21', '2012-10-30'),),
+        test_slices=(slice('2012-10-21', '2012-10-30'),),
+        oi_path=os.path.join(data_dir, FILES['oi_swot']),
+        obs_mask_path=os.path.join(data_dir, FILES['obs_swot']),
+        gt_path=os.path.join(data_dir, FILES['gt']),
+        dl_kwargs={'batch_size': batch_size, 'num_workers': num_workers, 'pin_memory': False},
+    )
+
+
+def _lit_model(patch, n_grad, **hparams):
+    from omegaconf import OmegaConf
+
+    import config
+    from models import LitModel
+
+    cfg = OmegaConf.create({**config.params, 'shapeData': [10, patch, patch], 'n_grad': n_grad, **hparams})
+    w_loss = np.zeros(cfg.dT)
+    w_loss[cfg.dT // 2] = 1.
+    return LitModel(hparam=cfg, w_loss=torch.Tensor(w_loss),
+                    mean_Tr=0., mean_Tt=0., mean_Val=0., var_Tr=1., var_Tt=1., var_Val=1.,
+                    min_lon=-65, max_lon=-55, min_lat=33, max_lat=43,
+                    ds_size_time=1, ds_size_lon=1, ds_size_lat=1)
+
+
+def _synthetic_batch(batch_size, patch, dT=5, obs_rate=.1):
+    oi = torch.randn(batch_size, dT, patch, patch)
+    mask = torch.rand(batch_size, dT, patch, patch) < obs_rate
+    gt = oi + .1 * torch.randn(batch_size, dT, patch, patch)
+    return oi, mask, gt
+
+
+def bench_data(data_dir, patch=200, workers=(0, 2, 4), n_batches=10, repeat=3):
+    res = {}
+    dm = _datamodule(data_dir, patch)
+    dm.setup('train')
+    ds = dm.train_ds
+    items = np.random.RandomState(0).randint(0, len(ds), 20)
+    res['dataset/getitem/patch=%d' % patch] = {
+        **timeit(lambda: [ds[i] for i in items], repeat=repeat), 'items': len(items)}
+
+    for num_workers in workers:
+        dl = _datamodule(data_dir, patch, num_workers=num_workers)
+        dl.norm_stats = dm.norm_stats
+        dl.setup('train')
+
+        def _epoch():
+            for i, _ in enumerate(dl.train_dataloader()):
+                if i + 1 == n_batches:
+                    break
+        r = timeit(_epoch, repeat=repeat, warmup=0)
+        r['batches_per_s'] = n_batches / r['mean_s']
+        res['dataloader/workers=%d' % num_workers] = r
+    return res
+
+
+def bench_solver(n_grads=(5, 10), patches=(100, 200), batch_size=2, repeat=3):
+    res = {}
+    for patch in patches:
+        for n_grad in n_grads:
+            solver = _lit_model(patch, n_grad).model
+            oi, mask, gt = _synthetic_batch(batch_size, patch)
+            x = torch.cat((oi, mask * (gt - oi)), dim=1)
+            masks = torch.cat((torch.ones_like(oi), mask.float()), dim=1)
+
+            def _fwd():
+                x_0 = x.clone().requires_grad_(True)
+                return solver.solve(x_0, x, masks)[0]
+
+            def _fwd_bwd():
+                _fwd().pow(2).mean().backward()
+
+            key = 'solver/n_grad=%d/patch=%d' % (n_grad, patch)
+            res[key + '/fwd'] = timeit(_fwd, repeat=repeat)
+            res[key + '/fwd_bwd'] = timeit(_fwd_bwd, repeat=repeat)
+    return res
+
+
+def bench_loss(patch=200, n_grad=5, batch_size=2, repeat=3):
+    mod = _lit_model(patch, n_grad)
+    batch = _synthetic_batch(batch_size, patch)
+    return {
+        'compute_loss/train': timeit(lambda: mod.compute_loss(batch, phase='train')[0].backward(), repeat=repeat),
+        'compute_loss/val': timeit(lambda: mod.compute_loss(batch, phase='val'), repeat=repeat),
+    }
+
+
+def bench_metrics(n_time=20, patch=200, repeat=3):
+    from metrics import mse_scores, nrmse_scores
+    from spectral import avg_err_rapsd2dv1
+
+    rng = np.random.RandomState(0)
+    gt = rng.randn(n_time, 5, patch, patch)
+    oi, pred = gt + .3 * rng.randn(*gt.shape), gt + .1 * rng.randn(*gt.shape)
+    with tempfile.TemporaryDirectory() as tmp:
+        return {
+            'metrics/nrmse_scores': timeit(lambda: nrmse_scores(gt, oi, pred, os.path.join(tmp, 'n.txt')), repeat),
+            'metrics/mse_scores': timeit(lambda: mse_scores(gt, oi, pred, os.path.join(tmp, 'm.txt')), repeat),
+            'spectral/avg_err_rapsd2dv1': timeit(lambda: avg_err_rapsd2dv1(pred[:, 2], gt[:, 2], 4., True), repeat),
+        }
+
+
+def bench_import(module='main'):
+    from check_import_time import import_times
+
+    return {'import/%s' % module: {'mean_s': import_times(module)[module][1], 'repeat': 1}}
+
+
+def run(out='bench.json', data_dir=None, suites=('import', 'data', 'solver', 'loss', 'metrics'), threads=None):
+    """
+    Run the benchmark suites on CPU and write the results to json
+    :param out: json file to write
+    :param data_dir: (Optional) directory of NATL60-like files, small synthetic files are generated if None
+    :param suites: suites to run among import, data, solver, loss, metrics
+    :param threads: (Optional) torch intra-op threads
+    """
+    import models
+    import solver
+
+    # the solver modules create their states on the global device, benchmark on CPU
+    solver.device = models.device = torch.device('cpu')
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(0)
+
+    tmp = None
+    if 'data' in suites and data_dir is None:
+        from synthetic_data import generate
+
+        tmp = tempfile.TemporaryDirectory()
+        data_dir = tmp.name
+        generate(out_dir=data_dir, n_time=31)
+
+    results = {}
+    for suite in suites:
+        print('... Bench %s' % suite)
+        if suite == 'data':
+            results.update(bench_data(data_dir))
+        else:
+            results.update(globals()['bench_' + suite]())
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads(),
+        },
+        'results': results,
+    }
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    for name, r in sorted(results.items()):
+        print('%-45s %9.4fs' % (name, r['mean_s']))
+    if tmp is not None:
+        tmp.cleanup()
+
+
+def compare(current, baseline, tolerance=.1):
+    """
+    Compare two benchmark files and flag the cases slower than the baseline by more than tolerance
+    :param current: json written by run
+    :param baseline: json written by run
+    :param tolerance: relative slowdown allowed
+    """
+    with open(current) as f:
+        cur = json.load(f)['results']
+    with open(baseline) as f:
+        base = json.load(f)['results']
+
+    regressions = []
+    for name in sorted(set(cur) & set(base)):
+        ratio = cur[name]['mean_s'] / max(base[name]['mean_s'], 1e-12)
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  <-- REGRESSION'
+            regressions.append(name)
+        print('%-45s %9.4fs %9.4fs  x%.2f%s' % (name, base[name]['mean_s'], cur[name]['mean_s'], ratio, flag))
+    for name in sorted(set(cur) ^ set(base)):
+        print('%-45s only in %s' % (name, current if name in cur else baseline))
+
+    if regressions:
+        print('... %d regression(s) over %d%%' % (len(regressions), 100 * tolerance))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire({'run': run, 'compare': compare})
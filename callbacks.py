@@ -0,0 +1,270 @@
+"""
+Lightning callbacks
+"""
+import atexit
+import os
+import queue
+import resource
+import threading
+import time
+import weakref
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from pytorch_lightning.callbacks import ModelCheckpoint
+
+
+class ThroughputMonitor(pl.Callback):
+    """
+    Per training step breakdown of the wall time:
+        data       waiting for the dataloader (end of the previous step -> start of this one)
+        h2d        host to device copy of the batch
+        solver     4DVarNN solver forward (also reported per solver iteration)
+        backward   loss terms and backward (solver end -> after backward)
+        optimizer  optimizer step and zero_grad (after backward -> end of step)
+        other      the rest of the step: hooks, logging, progress bar
+    plus the peak memory and the patches/s.
+    The means over every `log_every_n_steps` steps are logged as perf/* scalars and a summary table is printed
+    at the end of the training, telling whether the job is I/O, solver or logging bound.
+    """
+
+    STAGES = ('data', 'h2d', 'solver', 'backward', 'optimizer', 'other')
+
+    def __init__(self, log_every_n_steps=50, cuda_sync=True):
+        """
+        :param log_every_n_steps: steps averaged in each logged scalar
+        :param cuda_sync: synchronize cuda at each stage boundary, required for meaningful timings on gpu
+            at the cost of the overlap of the cuda kernels with the python code
+        """
+        self.log_every_n_steps = log_every_n_steps
+        self.cuda_sync = cuda_sync
+        self.steps = {k: [] for k in self.STAGES + ('step', 'solver_iter', 'patches')}
+        self._window = 0
+        self._handles = []
+        self._transfer = None
+        self._t = {}
+        self._n_iter = 0
+        self._last_batch_end = None
+
+    def _now(self, pl_module):
+        if self.cuda_sync and pl_module.device.type == 'cuda':
+            torch.cuda.synchronize(pl_module.device)
+        return time.perf_counter()
+
+    def on_train_start(self, trainer, pl_module):
+        solver = pl_module.model
+
+        def _solver_start(module, inputs):
+            self._n_iter = 0
+            self._t['solver_start'] = self._now(pl_module)
+
+        def _solver_end(module, inputs, outputs):
+            self._t['solver_end'] = self._now(pl_module)
+
+        def _grad_iter(module, inputs, outputs):
+            self._n_iter += 1
+
+        self._handles = [
+            solver.register_forward_pre_hook(_solver_start),
+            solver.register_forward_hook(_solver_end),
+            solver.model_Grad.register_forward_hook(_grad_iter),
+        ]
+
+        # the batch is copied to the device between on_train_batch_start and training_step
+        self._transfer = pl_module.transfer_batch_to_device
+
+        def _transfer_batch_to_device(*args, **kwargs):
+            t0 = self._now(pl_module)
+            batch = self._transfer(*args, **kwargs)
+            if pl_module.training:
+                self._t['h2d'] = self._t.get('h2d', 0.) + self._now(pl_module) - t0
+            return batch
+
+        pl_module.transfer_batch_to_device = _transfer_batch_to_device
+        if pl_module.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(pl_module.device)
+
+    def on_train_end(self, trainer, pl_module):
+        for h in self._handles:
+            h.remove()
+        self._handles = []
+        if self._transfer is not None:
+            del pl_module.transfer_batch_to_device
+            self._transfer = None
+        self.print_summary(pl_module)
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        # do not count the validation loop and the epoch hooks as dataloader wait
+        self._last_batch_end = None
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx=0):
+        self._t = {'start': self._now(pl_module)}
+
+    def on_after_backward(self, trainer, pl_module):
+        self._t['backward_end'] = self._now(pl_module)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        t = self._t
+        t_end = self._now(pl_module)
+        if 'solver_end' not in t:
+            # patch without observation: no solver call
+            self._last_batch_end = t_end
+            return
+        backward_end = t.get('backward_end', t['solver_end'])
+        step = {
+            'data': 0. if self._last_batch_end is None else t['start'] - self._last_batch_end,
+            'h2d': t.get('h2d', 0.),
+            'solver': t['solver_end'] - t['solver_start'],
+            'backward': backward_end - t['solver_end'],
+            'optimizer': t_end - backward_end,
+        }
+        step['other'] = max(t_end - t['start'] - sum(step[k] for k in self.STAGES[1:-1]), 0.)
+        step['step'] = sum(step.values())
+        step['solver_iter'] = step['solver'] / max(self._n_iter, 1)
+        step['patches'] = len(batch[0])
+        for k, v in step.items():
+            self.steps[k].append(v)
+        self._last_batch_end = t_end
+
+        self._window += 1
+        if self._window == self.log_every_n_steps:
+            self._log(trainer, pl_module)
+            self._window = 0
+
+    @staticmethod
+    def peak_memory(pl_module):
+        """
+        :return: peak memory in MB: allocated by torch on gpu, resident set size of the process on cpu
+        """
+        if pl_module.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(pl_module.device) / 2 ** 20
+        # ru_maxrss is in KB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+    def _log(self, trainer, pl_module):
+        n = self._window
+        metrics = {'perf/%s_s' % k: float(np.mean(self.steps[k][-n:])) for k in self.STAGES + ('step', 'solver_iter')}
+        metrics['perf/patches_per_s'] = float(np.sum(self.steps['patches'][-n:]) / np.sum(self.steps['step'][-n:]))
+        metrics['perf/peak_memory_mb'] = self.peak_memory(pl_module)
+        if trainer.logger is not None:
+            trainer.logger.log_metrics(metrics, step=trainer.global_step)
+
+    def print_summary(self, pl_module):
+        if not self.steps['step']:
+            return
+        total = np.sum(self.steps['step'])
+        print('*** Training throughput over %d steps: %.2f patches/s -- peak memory %.0f MB ***' % (
+            len(self.steps['step']), np.sum(self.steps['patches']) / total, self.peak_memory(pl_module)))
+        print('%-10s %10s %10s %10s %8s' % ('stage', 'mean (s)', 'p50 (s)', 'p95 (s)', 'share'))
+        for k in self.STAGES:
+            v = np.array(self.steps[k])
+            print('%-10s %10.4f %10.4f %10.4f %7.1f%%' % (
+                k, v.mean(), np.percentile(v, 50), np.percentile(v, 95), 100 * v.sum() / total))
+        print('%-10s %10.4f' % ('solver/it', np.mean(self.steps['solver_iter'])))
+        bound = max(self.STAGES, key=lambda k: np.sum(self.steps[k]))
+        labels = {'data': 'I/O', 'h2d': 'host to device copy', 'other': 'logging'}
+        print('... Mostly %s bound' % labels.get(bound, bound))
+
+
+def _to_host(obj):
+    # copy of the tensors of a checkpoint dict on the cpu: the training goes on updating the originals
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_host(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_host(v) for v in obj)
+    return obj
+
+
+def _flush(ckpt):
+    ckpt = ckpt()
+    if ckpt is not None:
+        ckpt.flush()
+
+
+class AsyncModelCheckpoint(ModelCheckpoint):
+    """
+    ModelCheckpoint writing the checkpoints on a background thread: the training thread only snapshots the
+    checkpoint to host memory, the file is written to `<path>.tmp` then renamed (no partial checkpoint on disk)
+    and the deletions of the top-k policy are queued after the writes. The queue is bounded (max_pending), a save
+    waits for the writer when it is full. The queue is flushed at the end of the training and at exit. The time
+    spent by the writes outside of the training thread is logged as checkpoint/time_saved_s.
+    """
+
+    def __init__(self, *args, max_pending=2, **kwargs):
+        """
+        :param max_pending: queued writes and deletions after which a save waits for the writer (each queued write
+            holds a host copy of the checkpoint), see ModelCheckpoint for the other arguments
+        """
+        super().__init__(*args, **kwargs)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._error = None
+        self.blocking_time = 0.
+        self.write_time = 0.
+        atexit.register(_flush, weakref.ref(self))
+
+    def _writer(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                action, filepath, checkpoint = task
+                if action == 'save':
+                    t0 = time.perf_counter()
+                    torch.save(checkpoint, filepath + '.tmp')
+                    os.replace(filepath + '.tmp', filepath)
+                    self.write_time += time.perf_counter() - t0
+                elif os.path.exists(filepath):
+                    os.remove(filepath)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _submit(self, task):
+        if self._error is not None:
+            raise RuntimeError('Checkpoint writing failed') from self._error
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer, daemon=True)
+            self._thread.start()
+        # blocks while max_pending tasks are queued: the host copies of a slow filesystem do not pile up
+        self._queue.put(task)
+
+    def _save_model(self, trainer, filepath):
+        t0 = time.perf_counter()
+        # every rank builds the checkpoint (as trainer.save_checkpoint), the global zero writes it
+        checkpoint = trainer.checkpoint_connector.dump_checkpoint(self.save_weights_only)
+        if trainer.is_global_zero:
+            os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+            self._submit(('save', filepath, _to_host(checkpoint)))
+        self.blocking_time += time.perf_counter() - t0
+        if trainer.is_global_zero and trainer.logger is not None:
+            # writes completed so far
+            trainer.logger.log_metrics({'checkpoint/time_saved_s': self.write_time,
+                                        'checkpoint/blocking_s': self.blocking_time}, step=trainer.global_step)
+
+    def _del_model(self, filepath):
+        if self._thread is not None:
+            self._submit(('del', filepath, None))
+        elif os.path.exists(filepath):
+            os.remove(filepath)
+
+    def flush(self):
+        """
+        Wait for the queued writes and deletions
+        """
+        if self._thread is None:
+            return
+        self._queue.join()
+        if self._error is not None:
+            raise RuntimeError('Checkpoint writing failed') from self._error
+
+    def on_train_end(self, trainer, pl_module):
+        self.flush()
+        if self.write_time:
+            print('... Checkpoints written in the background: %.2fs saved, %.2fs blocking' % (
+                self.write_time, self.blocking_time))
@@ -0,0 +1,78 @@
+"""
+Import-time guard: imports a module in a fresh interpreter with `python -X importtime`
+and fails if it takes longer than a budget or if it eagerly pulls in plotting / geo packages.
+
+Every dataloader worker, ddp rank and fire invocation pays this import cost, so keep it low.
+
+usage:
+    python check_import_time.py                      # checks `import main`
+    python check_import_time.py --module=models --budget=3
+"""
+import re
+import subprocess
+import sys
+
+# packages that must only be imported lazily, inside the functions that need them
+FORBIDDEN = (
+    'matplotlib',
+    'mpl_toolkits',
+    'cartopy',
+    'shapely',
+    'cv2',
+    'sklearn',
+    'scipy.stats',
+)
+
+_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def import_times(module):
+    """
+    Run `python -X importtime -c "import <module>"` and parse its report
+    :param module: module to import
+    :return: {<imported package>: (<self time (s)>, <cumulative time (s)>)...}
+    """
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    if res.returncode != 0:
+        raise RuntimeError('import %s failed:\n%s' % (module, res.stderr[-2000:]))
+    times = {}
+    for line in res.stderr.splitlines():
+        m = _LINE.match(line)
+        if m:
+            times[m.group(4)] = (int(m.group(1)) * 1e-6, int(m.group(2)) * 1e-6)
+    return times
+
+
+def check(module='main', budget=5., forbidden=FORBIDDEN, top=15):
+    """
+    :param module: module to check
+    :param budget: maximum cumulative import time in seconds
+    :param forbidden: packages that must not be imported at module import time
+    :param top: number of slowest packages to display
+    """
+    times = import_times(module)
+    total = times[module][1]
+
+    print('*** import %s: %.2fs (budget %.2fs) ***' % (module, total, budget))
+    for pkg, (self_t, cum_t) in sorted(times.items(), key=lambda kv: -kv[1][0])[:top]:
+        print('%8.3fs  %8.3fs  %s' % (self_t, cum_t, pkg))
+
+    loaded = sorted(
+        pkg for pkg in times
+        if any(pkg == f or pkg.startswith(f + '.') for f in forbidden)
+    )
+    if loaded:
+        print('... Forbidden eager imports: %s' % ', '.join(loaded))
+    if total > budget:
+        print('... Import time over budget by %.2fs' % (total - budget))
+    if loaded or total > budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(check)
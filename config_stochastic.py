@@ -1,6 +1,18 @@
 params = {
     'data_dir'        : '/gpfsscratch/rech/nlu/commun/large',
     'dir_save'        : '/gpfsscratch/rech/nlu/commun/large/results_maxime',
+    'norm_stats_path' : 'norm_stats.json', ## cache of the training set normalization stats (None to always recompute)
+    'throughput_monitor' : False, ## log the per step data / h2d / solver / backward / optimizer times (callbacks.ThroughputMonitor)
+    'throughput_log_every' : 50, ## training steps averaged in each perf/* scalar of the throughput monitor
+    'async_checkpoint' : False, ## write the checkpoints on a background thread (callbacks.AsyncModelCheckpoint)
+    'metrics_flush_every' : 50, ## training metrics accumulated on the device and reduced every N steps and per epoch (None: per step sync_dist)
+    'solver_diagnostics' : False, ## record and log the per iteration solver costs, gradient and update norms
+    'batch_size_schedule' : None, ## json written by `main.py tune_batch_size`: batch size of each n_grad stage
+    'patch_size_update' : None, ## size of the random crops of the training patches of each iter_update stage, eg [96, 96, 144, 200] (None: full patches), the batch size is scaled by the patch area
+    'max_batch_size' : None, ## upper bound of the batch sizes scaled with 'patch_size_update'
+    'cpu_processes' : None, ## ranks per node of a training on GPU-less nodes when not run by srun (see main_cpu.slurm)
+    'cpu_threads_per_rank' : None, ## torch intra-op threads of each CPU rank (default: compute threads of cpu_plan, or one per pinned core)
+    'cpu_plan' : True, ## on CPU, split the cores of each rank between dataloader workers and compute threads ('calibrate' to time a few splits)
 
     'iter_update'     : [0, 20, 40, 60, 100, 150, 800],  # [0,2,4,6,9,15]
     'nb_grad_update'  : [5, 5, 10, 10, 15, 15, 20, 20, 20],  # [0,0,1,2,3,3]#[0,2,2,4,5,5]#
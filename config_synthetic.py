@@ -0,0 +1,26 @@
+# Config running on the synthetic NATL60-like data generated by synthetic_data.py:
+#   python synthetic_data.py --out_dir=data/synthetic
+#   python main.py --config=synthetic --dataloading=new run
+from config import params as _params
+
+_data_dir = 'data/synthetic'
+
+params = {
+    **_params,
+    'data_dir'        : _data_dir,
+    'dir_save'        : _data_dir + '/results',
+    'norm_stats_path' : _data_dir + '/norm_stats.json',
+
+    # FourDVarNetDataModule arguments overriding the runner ones
+    'datamodule'      : {
+        'dim_range'    : {'lat': [33., 43.], 'lon': [-65., -55.]},
+        'oi_path'      : _data_dir + '/ssh_NATL60_swot_4nadir.nc',
+        'oi_var'       : 'ssh_mod',
+        'obs_mask_path': _data_dir + '/dataset_nadir_0d_swot.nc',
+        'obs_mask_var' : 'ssh_mod',
+        'gt_path'      : _data_dir + '/NATL60-CJM165_NATL_ssh_y2013.1y.nc',
+        'gt_var'       : 'ssh',
+        # only read with --dataloading=with_sst, which sets sst_var
+        'sst_path'     : _data_dir + '/NATL60-CJM165_NATL_sst_y2013.1y.nc',
+    },
+}
@@ -0,0 +1,229 @@
+"""
+CPU execution: SLURM environment, cores of the node and data-parallel training over gloo on GPU-less nodes.
+
+With `srun --ntasks-per-node=N --cpus-per-task=C` (see main_cpu.slurm) SLURM starts one rank per task and pins it
+to its C cores. Started by hand, the N ranks are spawned by lightning from the current process and the cores
+it may run on are split between them.
+The cores of each rank are then split between the dataloader workers and the intra-op threads (plan, calibrate)
+to avoid the oversubscription of torch, OpenMP and BLAS threads.
+"""
+import os
+
+import pytorch_lightning as pl
+import torch
+
+
+def _int_env(name, default=None):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    # SLURM_TASKS_PER_NODE / SLURM_NTASKS_PER_NODE style: "4(x2)" or "4,4"
+    return int(value.split('(')[0].split(',')[0])
+
+
+def slurm_env():
+    """
+    :return: {'num_nodes', 'node_rank', 'ntasks_per_node', 'local_rank', 'cpus_per_task'} from the SLURM variables
+        (single process defaults outside of SLURM)
+    """
+    return {
+        'num_nodes': _int_env('SLURM_JOB_NUM_NODES', 1),
+        'node_rank': _int_env('SLURM_NODEID', 0),
+        'ntasks_per_node': _int_env('SLURM_NTASKS_PER_NODE', _int_env('SLURM_TASKS_PER_NODE', 1)),
+        'local_rank': _int_env('SLURM_LOCALID', 0),
+        'cpus_per_task': _int_env('SLURM_CPUS_PER_TASK'),
+    }
+
+
+def available_cores():
+    """
+    :return: sorted ids of the cores the process may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def rank_cores(local_rank, local_world_size, cores=None):
+    """
+    :param local_rank: rank of the process on the node
+    :param local_world_size: number of processes on the node
+    :param cores: (Optional) cores shared by the processes, the available ones by default
+    :return: contiguous share of the cores of the process, all of them if SLURM already pinned the task
+    """
+    cores = available_cores() if cores is None else sorted(cores)
+    cpus_per_task = slurm_env()['cpus_per_task']
+    if local_world_size <= 1 or (cpus_per_task is not None and len(cores) <= cpus_per_task):
+        return cores
+    share = max(len(cores) // local_world_size, 1)
+    start = (local_rank * share) % len(cores)
+    return cores[start:start + share]
+
+
+def pin_process(cores, n_threads=None):
+    """
+    Pin the current process to cores and size its intra-op thread pool
+    :param n_threads: (Optional) torch intra-op threads, one per core by default
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    n_threads = n_threads or len(cores)
+    torch.set_num_threads(n_threads)
+    # inherited by the processes started from now on (dataloader workers)
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    return n_threads
+
+
+def cpu_trainer_kwargs(num_processes=None):
+    """
+    Trainer arguments of a CPU data-parallel run: one rank per SLURM task (or num_processes spawned ranks)
+    on each node, gloo process group
+    :param num_processes: (Optional) ranks per node when not run by srun on several tasks
+    """
+    env = slurm_env()
+    by_slurm = env['ntasks_per_node'] > 1 or env['num_nodes'] > 1
+    num_processes = env['ntasks_per_node'] if by_slurm else (num_processes or 1)
+    kwargs = {'num_nodes': env['num_nodes'], 'gpus': 0, 'num_processes': num_processes, 'accelerator': None}
+    if num_processes * env['num_nodes'] > 1:
+        os.environ.setdefault('PL_TORCH_DISTRIBUTED_BACKEND', 'gloo')
+        kwargs['accelerator'] = 'ddp_cpu'
+    if by_slurm:
+        from pytorch_lightning.plugins import DDPPlugin
+        from pytorch_lightning.plugins.environments import SLURMEnvironment
+
+        # lightning only lets SLURM start the CPU ranks when SLURM_NTASKS == num_processes, ie on a single node:
+        # the ranks started by srun are declared explicitly, none is spawned
+        kwargs['plugins'] = [DDPPlugin(parallel_devices=[torch.device('cpu')] * num_processes,
+                                       num_nodes=env['num_nodes'], cluster_environment=SLURMEnvironment())]
+    return kwargs
+
+
+class CpuAffinity(pl.Callback):
+    """
+    Pin each rank of a CPU run to its share of the cores of the node and set its intra-op threads
+    """
+
+    def __init__(self, threads_per_rank=None):
+        """
+        :param threads_per_rank: (Optional) torch intra-op threads of each rank, one per pinned core by default
+        """
+        self.threads_per_rank = threads_per_rank
+        self.cores = None
+
+    def on_pretrain_routine_start(self, trainer, pl_module):
+        # runs in each rank, unlike setup and on_fit_start which run before ddp_cpu spawns them
+        self._pin(trainer, pl_module)
+
+    def on_test_start(self, trainer, pl_module):
+        self._pin(trainer, pl_module)
+
+    def _pin(self, trainer, pl_module):
+        if pl_module.device.type != 'cpu' or self.cores is not None:
+            return
+        local_world_size = max(trainer.num_processes, 1)
+        self.cores = rank_cores(trainer.local_rank, local_world_size)
+        n_threads = pin_process(self.cores, self.threads_per_rank)
+        print('... Rank %d (node %d, local %d/%d): cores %s, %d threads' % (
+            trainer.global_rank, trainer.node_rank, trainer.local_rank, local_world_size,
+            _core_ranges(self.cores), n_threads))
+
+
+def _core_ranges(cores):
+    # compact "0-9,20-29" representation of core ids
+    ranges, start = [], None
+    for i, c in enumerate(cores):
+        if start is None:
+            start = c
+        if i + 1 == len(cores) or cores[i + 1] != c + 1:
+            ranges.append(str(start) if start == c else '%d-%d' % (start, c))
+            start = None
+    return ','.join(ranges)
+
+
+class WorkerInit:
+    """
+    Dataloader worker_init_fn limiting the torch, OpenMP and BLAS threads of the workers, after the
+    worker_init_fn it wraps (eg new_dataloading.worker_init_fn)
+    """
+
+    def __init__(self, n_threads=1, worker_init_fn=None):
+        self.n_threads = n_threads
+        self.worker_init_fn = worker_init_fn
+
+    def __call__(self, worker_id):
+        if self.worker_init_fn is not None:
+            self.worker_init_fn(worker_id)
+        torch.set_num_threads(self.n_threads)
+        for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+            os.environ[var] = str(self.n_threads)
+        try:
+            # the BLAS of numpy is already loaded in the worker: the variables above are not read anymore
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            return
+        threadpool_limits(self.n_threads)
+
+
+def plan(n_cores=None, num_workers=None, loader_share=.25, max_workers=8):
+    """
+    Split the cores of a rank between the dataloader workers (one thread each) and the intra-op threads of the
+    training process
+    :param n_cores: (Optional) cores of the rank, the available ones by default
+    :param num_workers: (Optional) dataloader workers, loader_share of the cores by default (none on 1-2 cores)
+    :param loader_share: fraction of the cores given to the workers
+    :param max_workers: upper bound of the default number of workers
+    :return: {'cores', 'num_workers', 'compute_threads', 'worker_threads'}
+    """
+    n_cores = n_cores or len(available_cores())
+    if num_workers is None:
+        num_workers = 0 if n_cores <= 2 else min(max(int(round(loader_share * n_cores)), 1), max_workers)
+    return {'cores': n_cores, 'num_workers': num_workers, 'compute_threads': max(n_cores - num_workers, 1),
+            'worker_threads': 1}
+
+
+def apply_plan(datamodule, cpu_plan):
+    """
+    Set the dataloader workers and their thread limits of a datamodule with dl_kwargs
+    (FourDVarNetDataModule, LegacyDataLoading) and the intra-op threads of the current process
+    """
+    worker_init_fn = datamodule.dl_kwargs.get('worker_init_fn')
+    if isinstance(worker_init_fn, WorkerInit):
+        worker_init_fn = worker_init_fn.worker_init_fn
+    datamodule.dl_kwargs['num_workers'] = cpu_plan['num_workers']
+    datamodule.dl_kwargs['worker_init_fn'] = WorkerInit(cpu_plan['worker_threads'], worker_init_fn)
+    torch.set_num_threads(cpu_plan['compute_threads'])
+    print('... CPU plan: %d cores -> %d dataloader workers (%d thread each), %d compute threads' % (
+        cpu_plan['cores'], cpu_plan['num_workers'], cpu_plan['worker_threads'], cpu_plan['compute_threads']))
+
+
+def calibrate(n_cores, make_loader, step, candidates=None, n_steps=5):
+    """
+    Pick the split of the cores with the best steps/s over a few training steps
+    :param n_cores: cores of the rank
+    :param make_loader: function of a plan returning an iterable of batches
+    :param step: function running a training step on a batch
+    :param candidates: (Optional) numbers of dataloader workers tried, 0 to half of the cores by default
+    :param n_steps: timed steps of each candidate, after one warmup step
+    :return: best plan, with the measured 'steps_per_s' of every candidate
+    """
+    import time
+
+    candidates = candidates or sorted({0, 1, 2, max(n_cores // 4, 1), max(n_cores // 2, 1)} & set(range(n_cores)))
+    rates = {}
+    for num_workers in candidates:
+        cpu_plan = plan(n_cores, num_workers=num_workers)
+        torch.set_num_threads(cpu_plan['compute_threads'])
+        batches = iter(make_loader(cpu_plan))
+        step(next(batches))
+        t0, n = time.perf_counter(), 0
+        for batch in batches:
+            step(batch)
+            n += 1
+            if n == n_steps:
+                break
+        rates[num_workers] = n / (time.perf_counter() - t0)
+        print('..... %d workers, %d compute threads: %.2f steps/s' % (
+            num_workers, cpu_plan['compute_threads'], rates[num_workers]))
+    best = plan(n_cores, num_workers=max(rates, key=rates.get))
+    best['steps_per_s'] = rates
+    return best
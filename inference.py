@@ -0,0 +1,208 @@
+"""
+Batched inference of a trained 4DVarNet model over an arbitrary region and period:
+the patches of a FourDVarNetDataset are spread over a pool of CPU worker processes
+and the reconstructed fields are stitched and written to a netcdf file as soon as they are complete.
+"""
+import multiprocessing as mp
+import time
+
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+# model and dataset of the current worker process, set by _init_worker
+_worker_model = None
+_worker_dataset = None
+
+
+def _init_worker(model, dataset, n_threads):
+    global _worker_model, _worker_dataset
+    torch.set_num_threads(n_threads)
+    _worker_model, _worker_dataset = model, dataset
+
+
+def _reconstruct_patches(items):
+    """
+    :param items: indices of the dataset patches to reconstruct
+    :return: items, reconstructed patches in physical units (n_items x win_time x win_lat x win_lon)
+    """
+    batch = _worker_model.on_after_batch_transfer(default_collate([_worker_dataset[item] for item in items]), 0)
+    loss, out, _ = _worker_model.compute_loss(batch, phase='test')
+    if loss is None:
+        # no observation in the batch, fall back on the OI
+        out = batch[0]
+    mean, std = _worker_dataset.norm_stats
+    return items, out.detach().cpu().numpy() * std + mean
+
+
+class NetcdfWriter:
+    """
+    Writes a (time, lat, lon) field one time step at a time along an unlimited time dimension
+    """
+
+    def __init__(self, path, lat, lon, var='ssh', time_units='days since 2012-10-01'):
+        import netCDF4
+
+        self.var = var
+        self.time_units = time_units
+        self.nc = netCDF4.Dataset(path, 'w')
+        self.nc.createDimension('time', None)
+        self.nc.createDimension('lat', len(lat))
+        self.nc.createDimension('lon', len(lon))
+        self.nc.createVariable('time', 'f8', ('time',))
+        self.nc['time'].units = time_units
+        self.nc.createVariable('lat', 'f4', ('lat',))[:] = lat
+        self.nc.createVariable('lon', 'f4', ('lon',))[:] = lon
+        self.nc.createVariable(var, 'f4', ('time', 'lat', 'lon'), zlib=True, fill_value=np.nan)
+
+    def write(self, t, field):
+        """
+        :param t: datetime64 of the time step
+        :param field: lat x lon array
+        """
+        i = len(self.nc.dimensions['time'])
+        origin = np.datetime64(self.time_units.split(' since ')[1].strip())
+        self.nc['time'][i] = (t - origin) / np.timedelta64(1, 'D')
+        self.nc[self.var][i] = field
+        self.nc.sync()
+
+    def close(self):
+        self.nc.close()
+
+
+def blending_window(n, kind='hann'):
+    """
+    1d blending weights of a patch dimension
+    :param n: window size
+    :param kind: 'hann' (weights tapering towards the patch borders, kept > 0 so that the domain borders stay
+        covered), 'uniform' or 'centre' (only the central element, as the loss weighting in training)
+    """
+    if kind == 'centre':
+        w = np.zeros(n, dtype=np.float32)
+        w[n // 2] = 1.
+        return w
+    if kind == 'uniform' or n <= 2:
+        return np.ones(n, dtype=np.float32)
+    if kind == 'hann':
+        return np.hanning(n + 2)[1:-1].astype(np.float32)
+    raise ValueError('Unknown blending window %s' % kind)
+
+
+class PatchStitcher:
+    """
+    Blends weighted, possibly overlapping, patches into full lat x lon frames and hands each frame to a writer
+    once no pending patch can contribute to it (patches are expected in dataset order, ie time-major).
+    The frames being accumulated live in a preallocated ring of win_time frames.
+    """
+
+    def __init__(self, xr_ds, writer, time_weights, space_weights=None):
+        """
+        :param xr_ds: XrDataset defining the patch geometry (window, strides, coordinates)
+        :param writer: object with a write(<time>, <lat x lon array>) method
+        :param time_weights: weight of each frame of the time window
+        :param space_weights: (Optional) win_lat x win_lon weights of each pixel of a patch, uniform by default
+        """
+        self.ds_size = xr_ds.ds_size
+        self.slice_win = xr_ds.slice_win
+        self.strides = {dim: xr_ds.strides.get(dim, 1) for dim in self.ds_size}
+        self.window = xr_ds.window
+        self.times = xr_ds.ds['time'].values
+        self.writer = writer
+        if space_weights is None:
+            space_weights = np.ones((self.slice_win['lat'], self.slice_win['lon']), dtype=np.float32)
+        # weight of each pixel of a patch
+        self.weights = np.asarray(time_weights, dtype=np.float32)[:, None, None] * space_weights[None]
+
+        win_time = self.slice_win['time']
+        shape = (win_time, xr_ds.ds.dims['lat'], xr_ds.ds.dims['lon'])
+        self.acc = np.zeros(shape, dtype=np.float32)
+        self.acc_w = np.zeros(shape, dtype=np.float32)
+        self.next_frame = 0
+        self.n_written = 0
+
+    def add(self, item, patch):
+        """
+        :param item: index of the patch in the dataset
+        :param patch: win_time x win_lat x win_lon reconstruction
+        """
+        window = self.window(item)
+        t0 = window['time'].start
+        sl = (window['lat'], window['lon'])
+
+        # patches arrive in time order: no later patch contributes to the frames before this one
+        self.flush(t0)
+        for k in range(self.weights.shape[0]):
+            if not self.weights[k].any():
+                continue
+            r = (t0 + k) % self.acc.shape[0]
+            self.acc[r][sl] += self.weights[k] * patch[k]
+            self.acc_w[r][sl] += self.weights[k]
+
+    def flush(self, until=None):
+        """
+        Write the frames before index `until` (all the frames if None), frames that got no weight are skipped
+        """
+        until = len(self.times) if until is None else min(until, len(self.times))
+        for t in range(self.next_frame, until):
+            r = t % self.acc.shape[0]
+            acc, acc_w = self.acc[r], self.acc_w[r]
+            if acc_w.any():
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    self.writer.write(self.times[t], np.where(acc_w > 0, acc / acc_w, np.nan))
+                self.n_written += 1
+            acc[:] = 0.
+            acc_w[:] = 0.
+        self.next_frame = max(self.next_frame, until)
+
+
+def reconstruct(model, dataset, writer, time_blend='centre', blend='hann', batch_size=2, n_workers=1,
+                threads_per_worker=1, log_every=100):
+    """
+    Reconstruct all the patches of dataset and stitch them into writer
+    :param model: LitModel in eval mode
+    :param dataset: FourDVarNetDataset with its normalization stats set
+    :param writer: see NetcdfWriter
+    :param time_blend: blending window of the frames of overlapping time windows, see blending_window.
+        'centre' only keeps the central frame of each window and needs a time stride of 1,
+        'uniform' or 'hann' keep all the frames and allow time strides up to win_time
+    :param blend: spatial blending window of overlapping patches, see blending_window
+    :param batch_size: patches per solver call
+    :param n_workers: number of worker processes, 0 to run in the current process
+    :param threads_per_worker: torch intra-op threads of each worker
+    :param log_every: print the throughput every log_every patches
+    :return: throughput in patches/s
+    """
+    n_items = len(dataset)
+    tasks = [list(range(i, min(i + batch_size, n_items))) for i in range(0, n_items, batch_size)]
+    win = dataset.gt_ds.slice_win
+    time_stride = dataset.gt_ds.strides.get('time', 1)
+    if time_stride > win['time'] or (time_blend == 'centre' and time_stride > 1):
+        raise ValueError('time stride %d leaves frames without reconstruction with a %s blending of %d frames windows'
+                         % (time_stride, time_blend, win['time']))
+    space_weights = np.outer(blending_window(win['lat'], blend), blending_window(win['lon'], blend))
+    stitcher = PatchStitcher(dataset.gt_ds, writer, blending_window(win['time'], time_blend), space_weights)
+
+    def _run(results):
+        n_done, t_start, next_log = 0, time.time(), log_every
+        for items, preds in results:
+            for item, pred in zip(items, preds):
+                stitcher.add(item, pred)
+            n_done += len(items)
+            if n_done >= next_log:
+                print('... %d/%d patches -- %.2f patches/s' % (n_done, n_items, n_done / (time.time() - t_start)))
+                next_log += log_every
+        stitcher.flush()
+        return n_done / max(time.time() - t_start, 1e-9)
+
+    if n_workers == 0:
+        _init_worker(model, dataset, threads_per_worker)
+        throughput = _run(map(_reconstruct_patches, tasks))
+    else:
+        # fork shares the loaded model with the workers without pickling it
+        ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        with ctx.Pool(n_workers, initializer=_init_worker, initargs=(model, dataset, threads_per_worker)) as pool:
+            throughput = _run(pool.imap(_reconstruct_patches, tasks))
+
+    print('*** Reconstructed %d patches (%d frames) -- %.2f patches/s ***' % (n_items, stitcher.n_written,
+                                                                              throughput))
+    return throughput
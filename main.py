@@ -4,6 +4,7 @@
 Created on Mon May 18 17:59:23 2020
 @author: rfablet
 """
+import json
 import os
 
 import numpy as np
@@ -13,10 +14,13 @@ from omegaconf import OmegaConf
 from pytorch_lightning.callbacks import ModelCheckpoint
 
 import solver as NN_4DVar
+from batch_tuner import BatchSizeSchedule, patch_size_stages
+from callbacks import AsyncModelCheckpoint, ThroughputMonitor
+import cpu_resources
+from cpu_resources import CpuAffinity, cpu_trainer_kwargs
 from lit_model_stochastic import LitModelStochastic
-from models import Gradient_img, LitModel, LitModelWithSST
+from models import DOMAIN_META, Gradient_img, LitModel, LitModelWithSST, ModelLR
 from new_dataloading import FourDVarNetDataModule
-from old_dataloading import LegacyDataLoading
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 gradient_img = Gradient_img()
@@ -37,6 +41,8 @@ class FourDVarNetRunner:
         self.wLoss = torch.Tensor(w_)
 
         if dataloading == "old":
+            # imported here: netCDF4 and scikit-learn are only needed by the legacy pipeline
+            from old_dataloading import LegacyDataLoading
             datamodule = LegacyDataLoading(self.cfg)
         elif dataloading == "with_sst":
             self.filename_chkpt = 'modelSLAInterpGF-withSST-Exp3-{epoch:02d}-{val_loss:.2f}'
@@ -62,7 +68,7 @@ class FourDVarNetRunner:
                 # 'lat': 20,
                 # 'lon': 20,
             }
-            datamodule = FourDVarNetDataModule(
+            datamodule = FourDVarNetDataModule(**self._datamodule_kwargs(
                 slice_win=slice_win,
                 dim_range=dim_range,
                 strides=strides,
@@ -73,8 +79,9 @@ class FourDVarNetRunner:
                 gt_path='/gpfsstore/rech/yrf/commun/NATL60/NATL/ref/NATL60-CJM165_NATL_ssh_y2013.1y.nc',
                 gt_var='ssh',
                 sst_path='/gpfsstore/rech/yrf/commun/NATL60/NATL/ref/NATL60-CJM165_NATL_sst_y2013.1y.nc',
-                sst_var='sst'
-            )
+                sst_var='sst',
+                norm_stats_path=self.cfg.get('norm_stats_path'),
+            ))
         else:
             # Specify the dataset spatial bounds
             dim_range = {
@@ -105,45 +112,108 @@ class FourDVarNetRunner:
                 # 'lat': 20,
                 # 'lon': 20,
             }
-            datamodule = FourDVarNetDataModule(
+            datamodule = FourDVarNetDataModule(**self._datamodule_kwargs(
                 slice_win=slice_win,
                 dim_range=dim_range,
                 strides=strides,
-            )
-
-        datamodule.setup()
-        self.dataloaders = {
-            'train': datamodule.train_dataloader(),
-            'val': datamodule.val_dataloader(),
-            'test': datamodule.val_dataloader(),
-        }
-        if dataloading == "old":
-            self.var_Tr = datamodule.var_Tr
-            self.var_Tt = datamodule.var_Tt
-            self.var_Val = datamodule.var_Val
-            self.mean_Tr = datamodule.mean_Tr
-            self.mean_Tt = datamodule.mean_Tt
-            self.mean_Val = datamodule.mean_Val
+                norm_stats_path=self.cfg.get('norm_stats_path'),
+            ))
+
+        self.dataloading = dataloading
+        self.datamodule = datamodule
+        self.dataloaders = {}
+
+        if self.cfg.stochastic == False:
+            self.lit_cls = LitModelWithSST if dataloading == "with_sst" else LitModel
+        else:
+            self.lit_cls = LitModelStochastic
+
+    def _datamodule_kwargs(self, **kwargs):
+        """
+        Override the datamodule arguments with the 'datamodule' entry of the config, if any
+        (eg data paths, dim_range bounds and time slices given as [start, end] lists)
+        """
+        overrides = self.cfg.get('datamodule')
+        for key, value in (OmegaConf.to_container(overrides, resolve=True) if overrides else {}).items():
+            if key == 'dim_range':
+                value = {dim: slice(*bounds) for dim, bounds in value.items()}
+            elif key.endswith('_slices'):
+                value = tuple(slice(*sl) for sl in value)
+            kwargs[key] = value
+        if kwargs.get('oi_lr_pool') not in (None, ModelLR.pool_size):
+            raise ValueError('oi_lr_pool must be the ModelLR pooling factor %d (low resolution loss target), got %s'
+                             % (ModelLR.pool_size, kwargs['oi_lr_pool']))
+        return kwargs
+
+    # datamodule split served by each dataloader
+    dataloader_split = {
+        'train': 'train',
+        'val': 'val',
+        'test': 'val',
+    }
+
+    def setup(self, stage=None, ckpt_path=None):
+        """
+        Open the data used by stage and set the normalization and domain attributes passed to the lightning module
+        :param stage: None (all dataloaders), 'train' (train and val dataloaders) or a dataloader name ('val', 'test')
+        :param ckpt_path: (Optional) Checkpoint whose normalization stats are used instead of scanning the training set
+        """
+        names = {None: ('train', 'val', 'test'), 'train': ('train', 'val')}.get(stage, (stage,))
+        if self.dataloading == "old":
+            if self.datamodule.var_Tr is None:
+                self.datamodule.setup()
+            self.var_Tr = self.datamodule.var_Tr
+            self.var_Tt = self.datamodule.var_Tt
+            self.var_Val = self.datamodule.var_Val
+            self.mean_Tr = self.datamodule.mean_Tr
+            self.mean_Tt = self.datamodule.mean_Tt
+            self.mean_Val = self.datamodule.mean_Val
             self.min_lon, self.max_lon, self.min_lat, self.max_lat = -65, -55, 33, 43
             self.ds_size_time = 20
             self.ds_size_lon = 1
             self.ds_size_lat = 1
         else:
-            self.mean_Tr = datamodule.norm_stats[0]
-            self.mean_Tt = datamodule.norm_stats[0]
-            self.mean_Val = datamodule.norm_stats[0]
-            self.var_Tr = datamodule.norm_stats[1] ** 2
-            self.var_Tt = datamodule.norm_stats[1] ** 2
-            self.var_Val = datamodule.norm_stats[1] ** 2
-            self.min_lon, self.max_lon, self.min_lat, self.max_lat = datamodule.bounding_box
-            self.ds_size_time = datamodule.ds_size['time']
-            self.ds_size_lon = datamodule.ds_size['lon']
-            self.ds_size_lat = datamodule.ds_size['lat']
+            if ckpt_path is not None and self.datamodule.norm_stats is None:
+                self.datamodule.norm_stats, self.datamodule.norm_stats_sst = self._ckpt_norm_stats(ckpt_path)
+            for name in names:
+                self.datamodule.setup(self.dataloader_split[name])
+            self.mean_Tr = self.datamodule.norm_stats[0]
+            self.mean_Tt = self.datamodule.norm_stats[0]
+            self.mean_Val = self.datamodule.norm_stats[0]
+            self.var_Tr = self.datamodule.norm_stats[1] ** 2
+            self.var_Tt = self.datamodule.norm_stats[1] ** 2
+            self.var_Val = self.datamodule.norm_stats[1] ** 2
+            self.min_lon, self.max_lon, self.min_lat, self.max_lat = self.datamodule.bounding_box
+            self.ds_size_time = self.datamodule.ds_size['time']
+            self.ds_size_lon = self.datamodule.ds_size['lon']
+            self.ds_size_lat = self.datamodule.ds_size['lat']
 
-        if self.cfg.stochastic == False:
-            self.lit_cls = LitModelWithSST if dataloading == "with_sst" else LitModel
-        else:
-            self.lit_cls = LitModelStochastic
+        for name in names:
+            if name not in self.dataloaders:
+                self.dataloaders[name] = getattr(self.datamodule, self.dataloader_split[name] + '_dataloader')()
+
+    @staticmethod
+    def _ckpt_norm_stats(ckpt_path):
+        """
+        :return: (mean, std), (mean_sst, std_sst) saved in the checkpoint hyperparameters, None for the stats
+            of checkpoints saved without them
+        """
+        hparams = torch.load(ckpt_path, map_location='cpu').get('hyper_parameters', {})
+        meta = hparams.get('domain_meta') or hparams.get('norm_stats')
+        if meta is None:
+            return None, None
+        return (meta['mean_Tr'], float(np.sqrt(meta['var_Tr']))), meta.get('norm_stats_sst')
+
+    def _domain_kwargs(self):
+        """
+        Normalization and domain attributes set by setup, None for the ones left to the checkpoint
+        """
+        kwargs = {k: getattr(self, k, None) for k in DOMAIN_META}
+        if self.dataloading != "old":
+            dm = self.datamodule
+            kwargs['norm_stats_sst'] = dm.norm_stats_sst
+            kwargs['tiling'] = {'slice_win': dm.slice_win, 'strides': dm.strides, 'dim_range': dm.dim_range}
+        return kwargs
 
     def run(self, ckpt_path=None, dataloader="test", **trainer_kwargs):
         """
@@ -163,23 +233,12 @@ class FourDVarNetRunner:
         """
 
         if ckpt_path:
-            mod = self.lit_cls.load_from_checkpoint(ckpt_path, w_loss=self.wLoss,
-                                                    mean_Tr=self.mean_Tr, mean_Tt=self.mean_Tt, mean_Val=self.mean_Val,
-                                                    var_Tr=self.var_Tr, var_Tt=self.var_Tt, var_Val=self.var_Val,
-                                                    min_lon=self.min_lon, max_lon=self.max_lon,
-                                                    min_lat=self.min_lat, max_lat=self.max_lat,
-                                                    ds_size_time=self.ds_size_time,
-                                                    ds_size_lon=self.ds_size_lon,
-                                                    ds_size_lat=self.ds_size_lat)
+            # the attributes not set by setup are restored from the checkpoint
+            mod = self.lit_cls.load_from_checkpoint(ckpt_path, w_loss=self.wLoss, **self._domain_kwargs())
         else:
-            mod = self.lit_cls(hparam=self.cfg, w_loss=self.wLoss,
-                               mean_Tr=self.mean_Tr, mean_Tt=self.mean_Tt, mean_Val=self.mean_Val,
-                               var_Tr=self.var_Tr, var_Tt=self.var_Tt, var_Val=self.var_Val,
-                               min_lon=self.min_lon, max_lon=self.max_lon,
-                               min_lat=self.min_lat, max_lat=self.max_lat,
-                               ds_size_time=self.ds_size_time,
-                               ds_size_lon=self.ds_size_lon,
-                               ds_size_lat=self.ds_size_lat)
+            mod = self.lit_cls(hparam=self.cfg, w_loss=self.wLoss, **self._domain_kwargs())
+        if self.dataloading != "old":
+            mod.batch_transform = self.datamodule.batch_transform()
         return mod
 
     def train(self, ckpt_path=None, **trainer_kwargs):
@@ -190,70 +249,226 @@ class FourDVarNetRunner:
         :return:
         """
 
-        ckpt_path = '/gpfswork/rech/yrf/ueh53pd/4dvarnet-core/lightning_logs/version_318238/checkpoints/modelSLAInterpGF-Exp3-epoch=37-val_loss=0.12.ckpt'
+        patch_sizes = patch_size_stages(self.cfg)
+        if patch_sizes:
+            if not hasattr(self.datamodule, 'set_patch_size'):
+                raise ValueError("'patch_size_update' needs the new dataloading")
+            # Phi_r pools by sS, as for the patch_size of reconstruct (the ModelLR pooling drops the remainder
+            # on both the output and the target side)
+            invalid = [size for size in patch_sizes.values() if size is not None and size % self.cfg.sS != 0]
+            if invalid:
+                raise ValueError('patch_size_update sizes must be multiples of sS=%d, got %s' % (self.cfg.sS, invalid))
 
+        self.setup('train', ckpt_path=ckpt_path)
         mod = self._get_model(ckpt_path=ckpt_path)
 
-        checkpoint_callback = ModelCheckpoint(monitor='val_loss',
-                                              filename=self.filename_chkpt,
-                                              save_top_k=3,
-                                              mode='min')
+        # AsyncModelCheckpoint writes the checkpoints on a background thread
+        checkpoint_cls = AsyncModelCheckpoint if self.cfg.get('async_checkpoint') else ModelCheckpoint
+        checkpoint_callback = checkpoint_cls(monitor='val_loss',
+                                             filename=self.filename_chkpt,
+                                             save_top_k=3,
+                                             mode='min')
         num_nodes = int(os.environ.get('SLURM_JOB_NUM_NODES', 1))
         num_gpus = torch.cuda.device_count()
         accelerator = "ddp" if (num_gpus * num_nodes) > 1 else None
-        trainer = pl.Trainer(num_nodes=num_nodes, gpus=num_gpus, accelerator=accelerator, auto_select_gpus=True,
-                             callbacks=[checkpoint_callback], **trainer_kwargs)
-        trainer.fit(mod, self.dataloaders['train'], self.dataloaders['val'])
+        callbacks = [checkpoint_callback]
+        if num_gpus == 0:
+            # GPU-less nodes: one rank per SLURM task (or cpu_processes ranks) over gloo, pinned to its cores
+            hw_kwargs = cpu_trainer_kwargs(self.cfg.get('cpu_processes'))
+            cpu_plan = self._plan_cpu(mod, hw_kwargs['num_processes']) if self.cfg.get('cpu_plan') else None
+            callbacks.append(CpuAffinity(threads_per_rank=self.cfg.get('cpu_threads_per_rank') or (
+                cpu_plan and cpu_plan['compute_threads'])))
+        else:
+            hw_kwargs = dict(num_nodes=num_nodes, gpus=num_gpus, accelerator=accelerator, auto_select_gpus=True)
+        if self.cfg.get('throughput_monitor'):
+            callbacks.append(ThroughputMonitor(log_every_n_steps=self.cfg.get('throughput_log_every', 50)))
+        scheduled = self.cfg.get('batch_size_schedule') or patch_sizes
+        if scheduled:
+            # the batch size (and patch size) follows the n_grad stages: the dataloaders are rebuilt by the datamodule
+            # every epoch
+            if self.cfg.get('batch_size_schedule'):
+                with open(self.cfg.batch_size_schedule) as f:
+                    schedule = json.load(f)['schedule']
+            else:
+                schedule = {0: self.datamodule.batch_size}
+            batch_size_schedule = BatchSizeSchedule(schedule, patch_sizes, self.cfg.get('max_batch_size'))
+            callbacks.append(batch_size_schedule)
+            batch_size_schedule.apply(self.datamodule, 0)
+            trainer_kwargs.setdefault('reload_dataloaders_every_epoch', True)
+        trainer = pl.Trainer(callbacks=callbacks, **{**hw_kwargs, **trainer_kwargs})
+        if scheduled:
+            trainer.fit(mod, datamodule=self.datamodule)
+        else:
+            trainer.fit(mod, self.dataloaders['train'], self.dataloaders['val'])
         return mod, trainer
 
+    def _plan_cpu(self, mod, num_processes):
+        """
+        Split the cores of each rank between the dataloader workers and the compute threads
+        (cpu_resources.plan, or timed by cpu_resources.calibrate with 'cpu_plan': 'calibrate') and rebuild the
+        training dataloaders accordingly
+        :return: the plan
+        """
+        n_cores = len(cpu_resources.rank_cores(cpu_resources.slurm_env()['local_rank'], num_processes))
+        if self.cfg.get('cpu_plan') == 'calibrate':
+            def _make_loader(cpu_plan):
+                cpu_resources.apply_plan(self.datamodule, cpu_plan)
+                return self.datamodule.train_dataloader()
+
+            def _step(batch):
+                loss, _, _ = mod.compute_loss(mod.on_after_batch_transfer(batch, 0), phase='train')
+                if loss is not None:
+                    loss.backward()
+                mod.zero_grad()
+
+            print('... Calibrate the CPU plan on %d cores' % n_cores)
+            cpu_plan = cpu_resources.calibrate(n_cores, _make_loader, _step)
+        else:
+            cpu_plan = cpu_resources.plan(n_cores)
+        cpu_resources.apply_plan(self.datamodule, cpu_plan)
+        for name in ('train', 'val'):
+            self.dataloaders[name] = getattr(self.datamodule, self.dataloader_split[name] + '_dataloader')()
+        return cpu_plan
+
+    def tune_batch_size(self, budget=None, out='batch_size_schedule.json', probe_sizes=(1, 2, 4), margin=.1,
+                        max_batch_size=64):
+        """
+        Find the largest batch size fitting a memory budget for every n_grad stage of the training schedule
+        (iter_update / nb_grad_update) by probing training steps on synthetic batches, see batch_tuner.py.
+        Set 'batch_size_schedule' to the written file in the config to train with it.
+        :param budget: (Optional) memory budget in GB, the whole memory of the device by default
+        :param out: json file where the schedule is written
+        :param probe_sizes: batch sizes probed for each n_grad
+        :param margin: fraction of the budget kept free
+        :param max_batch_size: upper bound of the batch size
+        """
+        import batch_tuner
+
+        # the data only sets the normalization and domain attributes, the probes run on synthetic batches
+        self.setup('val')
+        mod = self._get_model()
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        res = batch_tuner.tune(mod, budget=budget and budget * 2 ** 30,
+                               device=torch.device('cuda', local_rank) if torch.cuda.is_available() else 'cpu',
+                               probe_sizes=probe_sizes, margin=margin, max_batch_size=max_batch_size)
+        with open(out, 'w') as f:
+            json.dump(res, f, indent=2)
+        print('*** Batch size schedule (epoch: batch size) %s written to %s ***' % (res['schedule'], out))
+        return res
+
     def test(self, ckpt_path=None, dataloader="test", _mod=None, _trainer=None, **trainer_kwargs):
         """
         Test a model
-        :param ckpt_path: (Optional) Checkpoint from which to resume
+        :param ckpt_path: Checkpoint of the model to test, required unless the model is given (_mod)
         :param dataloader: Dataloader on which to run the test Checkpoint from which to resume
         :param trainer_kwargs: (Optional)
         """
-        #mod = _mod or self._get_model(ckpt_path=ckpt_path)
-        #ckpt_pth = '/gpfswork/rech/yrf/ueh53pd/4dvarnet-core/lightning_logs/version_296714/checkpoints/modelSLAInterpGF-Exp3-epoch=98-val_loss=0.05.ckpt'
-        #ckpt_pth = '/gpfswork/rech/yrf/ueh53pd/4dvarnet-core/lightning_logs/version_297967/checkpoints/modelSLAInterpGF-Exp3-epoch=39-val_loss=0.12.ckpt'
-        #ckpt_pth = '/gpfswork/rech/yrf/ueh53pd/4dvarnet-core/lightning_logs/version_318238/checkpoints/modelSLAInterpGF-Exp3-epoch=37-val_loss=0.12.ckpt'
-        ckpt_pth = '/gpfswork/rech/yrf/ueh53pd/4dvarnet-core/lightning_logs/version_319471/checkpoints/modelSLAInterpGF-Exp3-epoch=16-val_loss=0.11.ckpt'
-        mod = self._get_model(ckpt_path=ckpt_pth)
+        if _mod is None and ckpt_path is None:
+            raise ValueError('test needs a ckpt_path')
+        self.setup(dataloader, ckpt_path=None if _mod else ckpt_path)
+        mod = _mod or self._get_model(ckpt_path=ckpt_path)
         num_nodes = int(os.environ.get('SLURM_JOB_NUM_NODES', 1))
         num_gpus = torch.cuda.device_count()
         accelerator = "ddp" if (num_gpus * num_nodes) > 1 else None
         # trainer = _trainer or pl.Trainer(num_nodes=num_nodes, gpus=num_gpus, accelerator=accelerator, **trainer_kwargs)
-        trainer = pl.Trainer(num_nodes=1, gpus=1, accelerator=None, **trainer_kwargs)
+        if num_gpus == 0:
+            # test_epoch_end stitches the whole test period: a single process using all the cores
+            # (see reconstruct for a multi-process inference)
+            trainer = pl.Trainer(num_nodes=1, gpus=0, accelerator=None,
+                                 callbacks=[CpuAffinity(threads_per_rank=self.cfg.get('cpu_threads_per_rank'))],
+                                 **trainer_kwargs)
+        else:
+            trainer = pl.Trainer(num_nodes=1, gpus=1, accelerator=None, **trainer_kwargs)
         print(mod)
         trainer.test(mod, test_dataloaders=self.dataloaders[dataloader])
 
-    def profile(self):
+    def reconstruct(self, ckpt_path, output='reconstruction.nc', lat=None, lon=None, time=None,
+                    patch_size=None, overlap=0, blend='hann', time_stride=1, time_blend='centre',
+                    n_workers=4, threads_per_worker=1, batch_size=None):
         """
-        Run the profiling
-        :return:
+        Reconstruct a region and period on a pool of CPU worker processes,
+        the stitched fields are written to a netcdf file as they are completed
+        :param ckpt_path: Checkpoint to load
+        :param output: netcdf file to write
+        :param lat: (Optional) [min, max] latitudes, defaults to the datamodule domain
+        :param lon: (Optional) [min, max] longitudes, defaults to the datamodule domain
+        :param time: (Optional) [start, end] dates, defaults to the first test period
+        :param patch_size: (Optional) lat/lon size of the patches, defaults to the datamodule slice_win
+            (any multiple of sS, the solver is convolutional)
+        :param overlap: lat/lon overlap in pixels between neighbouring patches
+        :param blend: blending weights of overlapping patches: 'hann' or 'uniform'
+        :param time_stride: time stride between patches, up to dT
+        :param time_blend: 'centre' keeps only the central frame of each time window (as in test, time_stride=1),
+            'uniform' or 'hann' keep and blend all the frames (eg time_stride=dT for a dT-fold speedup)
+        :param n_workers: number of worker processes (0 to run in the current process)
+        :param threads_per_worker: torch intra-op threads of each worker
+        :param batch_size: (Optional) patches per solver call, defaults to the config batch size
         """
-        from pytorch_lightning.profiler import PyTorchProfiler
-
-        profiler = PyTorchProfiler(
-            "results/profile_report",
-            schedule=torch.profiler.schedule(
-                wait=1,
-                warmup=1,
-                active=1),
-            activities=[
-                torch.profiler.ProfilerActivity.CPU,
-                torch.profiler.ProfilerActivity.CUDA,
-            ],
-            on_trace_ready=torch.profiler.tensorboard_trace_handler('./tb_profile'),
-            record_shapes=True,
-            profile_memory=True,
-        )
-        self.train(
-            **{
-                'profiler': profiler,
-                'max_epochs': 1,
-            }
-        )
+        import inference
+
+        if self.dataloading == "old":
+            raise ValueError('reconstruct needs the xarray based dataloading (--dataloading=new or with_sst)')
+        if self.lit_cls is LitModelStochastic:
+            raise ValueError('reconstruct does not handle the stochastic model ensembles')
+
+        dm = self.datamodule
+        dim_range = {**dm.dim_range, 'time': dm.test_slices[0]}
+        for dim, bounds in (('lat', lat), ('lon', lon), ('time', time)):
+            if bounds is not None:
+                dim_range[dim] = slice(*bounds)
+
+        slice_win = dict(dm.slice_win)
+        if patch_size is not None:
+            if patch_size % self.cfg.sS != 0:
+                raise ValueError('patch_size must be a multiple of sS=%d' % self.cfg.sS)
+            slice_win['lat'] = slice_win['lon'] = patch_size
+        strides = {'time': time_stride, 'lat': slice_win['lat'] - overlap, 'lon': slice_win['lon'] - overlap}
+        if min(strides['lat'], strides['lon']) <= 0:
+            raise ValueError('overlap must be smaller than the patch size')
+
+        if dm.norm_stats is None:
+            dm.norm_stats, dm.norm_stats_sst = self._ckpt_norm_stats(ckpt_path)
+        dm.setup_norm_stats()
+        # the last patches are clamped to the end of the domain and period when the strides do not fit them
+        ds = dm.build_ds([dim_range.pop('time')], dim_range=dim_range, slice_win=slice_win, strides=strides,
+                         cover=True)
+        dm.set_norm_stats(ds, dm.norm_stats, dm.norm_stats_sst)
+
+        self.mean_Tr = self.mean_Tt = self.mean_Val = dm.norm_stats[0]
+        self.var_Tr = self.var_Tt = self.var_Val = dm.norm_stats[1] ** 2
+        self.min_lon, self.max_lon, self.min_lat, self.max_lat = dm.get_domain_bounds(ds)
+        ds = ds.datasets[0]
+        self.ds_size_time, self.ds_size_lat, self.ds_size_lon = (ds.gt_ds.ds_size[dim] for dim in ('time', 'lat', 'lon'))
+
+        mod = self._get_model(ckpt_path=ckpt_path).to('cpu').eval()
+        lat_coords, lon_coords = ds.gt_ds.ds['lat'].values, ds.gt_ds.ds['lon'].values
+        writer = inference.NetcdfWriter(output, lat_coords, lon_coords)
+        try:
+            return inference.reconstruct(mod, ds, writer, time_blend=time_blend, blend=blend,
+                                         batch_size=batch_size or self.cfg.batch_size,
+                                         n_workers=n_workers, threads_per_worker=threads_per_worker)
+        finally:
+            writer.close()
+
+    def profile(self, ckpt_path=None, steps=5, warmup=2, out_dir='profile', modules=None, with_stack=True):
+        """
+        Profile a fixed number of training steps, on cpu or gpu, see profiling.py
+        :param ckpt_path: (Optional) Checkpoint of the profiled model, randomly initialized otherwise
+        :param steps: number of profiled training steps
+        :param warmup: number of steps run before profiling
+        :param out_dir: directory of the chrome trace, flamegraph stacks and summaries
+        :param modules: (Optional) solver submodules to attribute time and memory to (default profiling.SOLVER_MODULES)
+        :param with_stack: record the python stacks, required for the flamegraphs
+        :return: out_dir
+        """
+        import profiling
+
+        self.setup('train', ckpt_path=ckpt_path)
+        mod = self._get_model(ckpt_path=ckpt_path).to(device)
+        # the profiler itself is not returned: fire would print its help page
+        profiling.profile(mod, self.dataloaders['train'], steps=steps, warmup=warmup,
+                          modules=modules or profiling.SOLVER_MODULES, out_dir=out_dir, with_stack=with_stack)
+        return out_dir
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+"""
+Buffered metric logging: the per step values are accumulated on their device, without host synchronization,
+and reduced across the ranks in a single all-reduce every `flush_every` steps and at the end of the epoch,
+instead of one host sync and one all-reduce per metric and step.
+"""
+import torch
+
+
+class MetricBuffer:
+    """
+    Running sums of scalar metrics on the device, over a window of steps and over the epoch
+    """
+
+    def __init__(self, names, flush_every=50):
+        """
+        :param names: names of the metrics, the same on every rank (all of them are reduced together)
+        :param flush_every: steps between two reductions of the window means
+        """
+        self.names = sorted(names)
+        self.flush_every = flush_every
+        self.window = {}
+        self.epoch = {}
+        self.n_window = 0
+        self.n_epoch = 0
+
+    def add(self, **values):
+        """
+        Accumulate the values of a step (tensors on the device or python numbers)
+        """
+        for name, value in values.items():
+            value = value.detach() if torch.is_tensor(value) else torch.tensor(float(value))
+            for sums in (self.window, self.epoch):
+                sums[name] = sums[name] + value if name in sums else value.clone()
+        self.n_window += 1
+        self.n_epoch += 1
+
+    def ready(self, batch_idx):
+        """
+        :param batch_idx: index of the step in the epoch, the ranks must flush at the same steps (collective)
+            even when some of them skipped the step
+        :return: whether the window should be flushed after this step
+        """
+        return self.flush_every is not None and (batch_idx + 1) % self.flush_every == 0
+
+    def _reduce(self, sums, n_steps, device):
+        """
+        :return: {<name>: <mean over the steps of all the ranks>} as python floats, None without any step
+        """
+        zero = torch.zeros((), dtype=torch.float64, device=device)
+        # the sums and the number of steps of every metric in a single all-reduce and a single host copy
+        buf = torch.stack([sums[name].to(device, torch.float64).reshape(()) if name in sums else zero
+                           for name in self.names]
+                          + [torch.tensor(float(n_steps), dtype=torch.float64, device=device)])
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(buf)
+        buf = buf.tolist()
+        if buf[-1] == 0:
+            return None
+        return {name: s / buf[-1] for name, s in zip(self.names, buf[:-1])}
+
+    def flush_window(self, device):
+        """
+        :param device: device of the reduction (the one of the process group backend)
+        :return: means over the window steps of all the ranks, the window is reset
+        """
+        means = self._reduce(self.window, self.n_window, device)
+        self.window, self.n_window = {}, 0
+        return means
+
+    def flush_epoch(self, device):
+        """
+        :param device: device of the reduction (the one of the process group backend)
+        :return: means over the epoch steps of all the ranks, the epoch and window sums are reset
+        """
+        means = self._reduce(self.epoch, self.n_epoch, device)
+        self.window, self.n_window = {}, 0
+        self.epoch, self.n_epoch = {}, 0
+        return means
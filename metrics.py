@@ -1,25 +1,18 @@
 import datetime
 import numpy as np
-import xarray as xr
-import matplotlib
-matplotlib.use('Agg') # Must be before importing matplotlib.pyplot or pylab!
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib import cm
-from matplotlib.ticker import LinearLocator, FormatStrFormatter
-import pandas as pd
-import shapely
-from shapely import wkt
-#import geopandas as gpd
-from cartopy import crs as ccrs
-import cartopy.feature as cfeature
-from cartopy.io import shapereader
-from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
-import cv2
-import matplotlib.animation as animation
 
 from spectral import *
 
+
+# plotting and geo packages (matplotlib, cartopy, cv2) are imported inside the functions that use them:
+# they take seconds to load and are only needed at test time, not in dataloader workers or ddp ranks
+def _pyplot():
+    import matplotlib
+    matplotlib.use('Agg') # Must be before importing matplotlib.pyplot or pylab!
+    import matplotlib.pyplot as plt
+    return plt
+
+
 def plot_snr(gt,oi,pred,resfile):
     '''
     gt: 3d numpy array (Ground Truth)
@@ -27,6 +20,7 @@ def plot_snr(gt,oi,pred,resfile):
     pred: 3d numpy array (4DVarNet-based predictions)
     resfile: string
     '''
+    plt = _pyplot()
 
     dt = pred.shape[1]
 
@@ -64,6 +58,7 @@ def plot_nrmse(gt, oi, pred, resfile, index_test):
     resfile: string
     index_test: 1d numpy array (ex: np.concatenate([np.arange(60, 80)]))
     '''
+    plt = _pyplot()
 
     # Compute daily nRMSE scores
     nrmse_oi = []
@@ -101,6 +96,7 @@ def plot_mse(gt, oi, pred, resfile, index_test):
     resfile: string
     index_test: 1d numpy array (ex: np.concatenate([np.arange(60, 80)]))
     '''
+    plt = _pyplot()
 
     # Compute daily nRMSE scores
     mse_oi = []
@@ -142,6 +138,9 @@ def plot_mse(gt, oi, pred, resfile, index_test):
 
 
 def plot(ax,i,j,lon,lat,data,title,extent=[-65,-55,30,40],cmap="coolwarm",gridded=True,vmin=-2,vmax=2,colorbar=True,orientation="horizontal"):
+    plt = _pyplot()
+    from cartopy import crs as ccrs
+    from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
     ax[i][j].set_extent(list(extent))
     if gridded:
         im=ax[i][j].pcolormesh(lon, lat, data, cmap=cmap,\
@@ -166,6 +165,7 @@ def plot(ax,i,j,lon,lat,data,title,extent=[-65,-55,30,40],cmap="coolwarm",gridde
 
 def gradient(img, order):
     """ calcuate x, y gradient and magnitude """
+    import cv2
     sobelx = cv2.Sobel(img,cv2.CV_64F,1,0,ksize=3)
     sobelx = sobelx/8.0
     sobely = cv2.Sobel(img,cv2.CV_64F,0,1,ksize=3)
@@ -179,6 +179,8 @@ def gradient(img, order):
         return sobel_norm
 
 def plot_maps(gt,oi,pred,lon,lat,resfile):
+    plt = _pyplot()
+    from cartopy import crs as ccrs
 
     vmax = np.nanmax(np.abs(gt))
     vmin = -1.*vmax
@@ -202,6 +204,9 @@ def plot_maps(gt,oi,pred,lon,lat,resfile):
 
 
 def animate_maps(gt,oi,pred,lon,lat,resfile,orthographic=True):
+    plt = _pyplot()
+    import matplotlib.animation as animation
+    from cartopy import crs as ccrs
 
     def animate(i, fig, ax):
         plot(ax,0,0,lon,lat,gt[i],'GT',extent=extent,cmap="coolwarm",vmin=vmin,vmax=vmax,colorbar=False)
@@ -236,6 +241,8 @@ def animate_maps(gt,oi,pred,lon,lat,resfile,orthographic=True):
     plt.close()
 
 def plot_ensemble(pred,lon,lat,resfile):
+    plt = _pyplot()
+    from cartopy import crs as ccrs
 
     vmax = np.nanmax(np.abs(pred))
     vmin = -1.*vmax
@@ -260,6 +267,7 @@ def save_netcdf(saved_path1, pred, lon, lat, index_test):
     lat: 1d numpy array
     index_test: 1d numpy array (ex: np.concatenate([np.arange(60, 80)]))
     '''
+    import xarray as xr
 
     mesh_lat, mesh_lon = np.meshgrid(lat, lon)
     mesh_lat = mesh_lat.T
@@ -5,9 +5,10 @@ import torch
 import torch.nn.functional as F
 import torch.optim as optim
 from omegaconf import OmegaConf
-from scipy import stats
 
 import solver as NN_4DVar
+from baseline_metrics import BaselineCache, baseline_metrics, baseline_sums
+from metric_buffer import MetricBuffer
 from metrics import save_netcdf, nrmse_scores, mse_scores, plot_nrmse, plot_mse, plot_snr, plot_maps, animate_maps, plot_ensemble
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -182,42 +183,85 @@ class Gradient_img(torch.nn.Module):
         return G
 
 class ModelLR(torch.nn.Module):
+    # pooling factor of the low resolution fields, the one of the precomputed OI (datamodule oi_lr_pool) too
+    pool_size = 16
+
     def __init__(self):
         super(ModelLR, self).__init__()
 
-        self.pool = torch.nn.AvgPool2d((16, 16))
+        self.pool = torch.nn.AvgPool2d((self.pool_size, self.pool_size))
 
     def forward(self, im):
         return self.pool(im)
 
 
 ############################################ Lightning Module #######################################################################
+# normalization stats and domain attributes of LitModel
+DOMAIN_META = ('mean_Tr', 'mean_Tt', 'mean_Val', 'var_Tr', 'var_Tt', 'var_Val', 'min_lon', 'max_lon', 'min_lat',
+               'max_lat', 'ds_size_time', 'ds_size_lon', 'ds_size_lat')
+
+
+def _plain(value):
+    # python scalars / lists / dicts of a value (numpy scalars, slices), storable in the hparams yaml
+    if isinstance(value, dict):
+        return {str(k): _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, slice):
+        return [_plain(value.start), _plain(value.stop)]
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def domain_meta(hparams, kwargs):
+    """
+    :param hparams: model hyperparameters, with the 'domain_meta' of a checkpoint
+        (or the 'norm_stats' of the checkpoints saved before it)
+    :param kwargs: LitModel kwargs: DOMAIN_META attributes, 'norm_stats_sst' (mean, std) and 'tiling'
+        ({'slice_win', 'strides', 'dim_range'} of the patches), overriding the saved ones
+    :return: {<attribute>: <value>} metadata of the data the model is trained on
+    """
+    meta = dict(hparams.get('domain_meta') or {})
+    if 'norm_stats' in hparams:
+        meta = {**{k + s: hparams['norm_stats'][k + 'Tr'] for k in ('mean_', 'var_') for s in ('Tr', 'Tt', 'Val')},
+                **meta}
+    meta.update({k: kwargs[k] for k in DOMAIN_META + ('norm_stats_sst', 'tiling') if kwargs.get(k) is not None})
+    missing = [k for k in DOMAIN_META if k not in meta]
+    if missing:
+        raise ValueError('%s are neither given nor saved in the checkpoint' % ', '.join(missing))
+    return _plain(meta)
+
+
 class LitModel(pl.LightningModule):
     def __init__(self, hparam, *args, **kwargs):
         super().__init__()
         hparams = hparam if isinstance(hparam, dict) else OmegaConf.to_container(hparam, resolve=True)
         self.save_hyperparameters(hparams)
-        self.var_Val = kwargs['var_Val']
-        self.var_Tr = kwargs['var_Tr']
-        self.var_Tt = kwargs['var_Tt']
+        # normalization stats, domain and tiling of the data, saved with the hyperparameters: a checkpoint
+        # restores them without the data, the kwargs given override them
+        self.hparams.domain_meta = domain_meta(self.hparams, kwargs)
+        meta = self.hparams.domain_meta
 
         # create longitudes & latitudes coordinates
-        self.xmin = kwargs['min_lon']
-        self.xmax = kwargs['max_lon']
-        self.ymin = kwargs['min_lat']
-        self.ymax = kwargs['max_lat']
+        self.xmin = meta['min_lon']
+        self.xmax = meta['max_lon']
+        self.ymin = meta['min_lat']
+        self.ymax = meta['max_lat']
         self.lon = np.arange(self.xmin, self.xmax + .05, .05)
         self.lat = np.arange(self.ymin, self.ymax + .05, .05)
-        self.ds_size_time = kwargs['ds_size_time']
-        self.ds_size_lon = kwargs['ds_size_lon']
-        self.ds_size_lat = kwargs['ds_size_lat']
-
-        self.var_Val = kwargs['var_Val']
-        self.var_Tr = kwargs['var_Tr']
-        self.var_Tt = kwargs['var_Tt']
-        self.mean_Val = kwargs['mean_Val']
-        self.mean_Tr = kwargs['mean_Tr']
-        self.mean_Tt = kwargs['mean_Tt']
+        self.ds_size_time = meta['ds_size_time']
+        self.ds_size_lon = meta['ds_size_lon']
+        self.ds_size_lat = meta['ds_size_lat']
+
+        self.var_Val = meta['var_Val']
+        self.var_Tr = meta['var_Tr']
+        self.var_Tt = meta['var_Tt']
+        self.mean_Val = meta['mean_Val']
+        self.mean_Tr = meta['mean_Tr']
+        self.mean_Tt = meta['mean_Tt']
         # main model
         self.model = NN_4DVar.Solver_Grad_4DVarNN(
             Phi_r(self.hparams.shapeData[0], self.hparams.DimAE, self.hparams.dW, self.hparams.dW2, self.hparams.sS,
@@ -231,17 +275,134 @@ class LitModel(pl.LightningModule):
         self.gradient_img = Gradient_img()
         # loss weghing wrt time
 
-        self.w_loss = torch.nn.Parameter(kwargs['w_loss'], requires_grad=False)  # duplicate for automatic upload to gpu
+        # restored from the state dict when loading a checkpoint without w_loss
+        w_loss = kwargs['w_loss'] if kwargs.get('w_loss') is not None else torch.zeros(self.hparams.dT)
+        self.w_loss = torch.nn.Parameter(w_loss, requires_grad=False)  # duplicate for automatic upload to gpu
         self.x_gt = None  # variable to store Ground Truth
         self.x_oi = None  # variable to store OI
         self.x_rec = None  # variable to store output of test method
         self.test_figs = {}
+        # (Optional) restores on the device the batches of a dataset with packed mask / compact floats,
+        # see new_dataloading.BatchTransform
+        self.batch_transform = None
+        # whether the batch has observations, checked on the host before its transfer (no device sync in the step)
+        self._host_has_obs = None
+        # training metrics accumulated on the device and reduced every metrics_flush_every steps
+        # (None: logged and reduced across the ranks at each step)
+        self.metric_buffer = MetricBuffer(('loss', 'tr_mse', 'tr_mseG'), self.hparams.get('metrics_flush_every'))
+        # per item extras of the batch on the device (eg precomputed low resolution OI, see
+        # new_dataloading.FourDVarNetDataset) and host copy of their dataset index
+        self._batch_extras = None
+        self._host_index = None
+        # baseline metrics of the patches already seen, looked up by dataset index
+        self.baseline_cache = BaselineCache()
 
         self.automatic_optimization = self.hparams.automatic_optimization
 
     def forward(self):
         return 1
 
+    @property
+    def solver_diagnostics(self):
+        # per iteration record of the solver costs, gradient and update norms (see solver.SolverDiagnostics)
+        return self.model.diagnostics
+
+    def setup(self, stage=None):
+        self.solver_diagnostics.enabled = self.hparams.get('solver_diagnostics', False)
+        # the dataset indices may refer to other patches
+        self.baseline_cache.reset()
+
+    @staticmethod
+    def _split_extras(batch):
+        # the item extras are a dict after the fields of the batch
+        if isinstance(batch[-1], dict):
+            return batch[:-1], batch[-1]
+        return batch, None
+
+    def on_before_batch_transfer(self, batch, dataloader_idx=0):
+        # the extras are transferred with the batch, the dataset index is also kept on the host
+        extras = self._split_extras(batch)[1]
+        self._host_index = None if extras is None else extras.get('index')
+        mask = batch[1]
+        if mask.device.type == 'cpu':
+            # raw items: observation field with NaNs, otherwise (packed) boolean mask
+            self._host_has_obs = bool((~torch.isnan(mask)).any() if mask.is_floating_point() else mask.any())
+        return batch
+
+    def has_obs(self, inputs_Mask):
+        """
+        :return: whether the batch mask has observations, from the host check of the batch when there was one
+        """
+        has_obs, self._host_has_obs = self._host_has_obs, None
+        if has_obs is None:
+            has_obs = inputs_Mask.sum().item() != 0
+        return has_obs
+
+    def on_after_batch_transfer(self, batch, dataloader_idx=0):
+        batch, self._batch_extras = self._split_extras(batch)
+        if self._batch_extras is not None and self._host_index is not None:
+            self._batch_extras['index'] = self._host_index
+        self._host_index = None
+        if self.batch_transform is not None:
+            batch = self.batch_transform(batch)
+        return batch
+
+    def targets_lr(self, targets_OI):
+        """
+        :return: low resolution OI target of the loss, the one precomputed by the dataset if the batch carries it
+        """
+        oi_lr = (self._batch_extras or {}).get('oi_lr')
+        return self.model_LR(targets_OI) if oi_lr is None else oi_lr
+
+    def baseline_metrics(self, targets_OI, targets_GT, g_targets_GT, phase):
+        """
+        :return: loss_OI, loss_GOI, mean_GAll of the batch, with the per patch terms cached in the train and val phases
+            when the batch carries the dataset index of its patches
+        """
+        index = (self._batch_extras or {}).get('index')
+        sums = None
+        if index is not None and phase in ('train', 'val'):
+            sums = self.baseline_cache.get(phase, index)
+        if sums is None:
+            sums = baseline_sums(targets_OI, targets_GT, g_targets_GT, self.gradient_img, self.w_loss)
+            if index is not None and phase in ('train', 'val'):
+                self.baseline_cache.put(phase, index, sums)
+        return baseline_metrics(sums.to(targets_GT.device), self.w_loss)
+
+    def log_solver_diagnostics(self, phase):
+        """
+        Log the solver diagnostics recorded in phase as histograms (and means) per solver iteration and reset them
+        """
+        if not self.solver_diagnostics.enabled:
+            return
+        values = self.solver_diagnostics.get(phase)
+        self.solver_diagnostics.reset(phase)
+        if not values or self.logger is None:
+            return
+        metrics = {}
+        for field, v in values.items():
+            for k in range(v.shape[1]):
+                tag = 'solver_%s/%s/it%02d' % (phase, field, k)
+                metrics[tag] = float(np.mean(v[:, k]))
+                if hasattr(self.logger.experiment, 'add_histogram'):
+                    self.logger.experiment.add_histogram(tag, v[:, k], self.current_epoch)
+        self.logger.log_metrics(metrics, step=self.global_step)
+
+    def on_train_epoch_end(self, *args):
+        if self.metric_buffer.flush_every:
+            means = self.metric_buffer.flush_epoch(self.device)
+            if means is not None:
+                self.log("loss_epoch", means['loss'], prog_bar=True, logger=True)
+                self.log("tr_mse", means['tr_mse'], prog_bar=True, logger=True)
+                self.log("tr_mseG", means['tr_mseG'], prog_bar=True, logger=True)
+        self.log_solver_diagnostics('train')
+
+    def on_validation_epoch_end(self):
+        self.log_solver_diagnostics('val')
+
+    def on_test_epoch_end(self):
+        self.log_solver_diagnostics('test')
+
     def configure_optimizers(self):
 
         optimizer = optim.Adam([{'params': self.model.model_Grad.parameters(), 'lr': self.hparams.lr_update[0]},
@@ -276,15 +437,26 @@ class LitModel(pl.LightningModule):
 
         # compute loss and metrics    
         loss, out, metrics = self.compute_loss(train_batch, phase='train')
+        if self.metric_buffer.flush_every:
+            if loss is not None:
+                self.metric_buffer.add(loss=loss, tr_mse=metrics['mse'] / self.var_Tr,
+                                       tr_mseG=metrics['mseGrad'] / metrics['meanGrad'])
+            # on every rank, including the ones without observations in this step
+            if self.metric_buffer.ready(batch_idx):
+                means = self.metric_buffer.flush_window(self.device)
+                if means is not None:
+                    self.log("loss_step", means['loss'], on_step=True, on_epoch=False, prog_bar=True, logger=True)
         if loss is None:
             return loss
         # log step metric        
         # self.log('train_mse', mse)
         # self.log("dev_loss", mse / var_Tr , on_step=True, on_epoch=True, prog_bar=True, sync_dist=True)
-        self.log("loss", loss, on_step=True, on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
-        self.log("tr_mse", metrics['mse'] / self.var_Tr, on_step=False, on_epoch=True, prog_bar=True, sync_dist=True)
-        self.log("tr_mseG", metrics['mseGrad'] / metrics['meanGrad'], on_step=False, on_epoch=True, prog_bar=True,
-                 sync_dist=True)
+        if not self.metric_buffer.flush_every:
+            self.log("loss", loss, on_step=True, on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
+            self.log("tr_mse", metrics['mse'] / self.var_Tr, on_step=False, on_epoch=True, prog_bar=True,
+                     sync_dist=True)
+            self.log("tr_mseG", metrics['mseGrad'] / metrics['meanGrad'], on_step=False, on_epoch=True,
+                     prog_bar=True, sync_dist=True)
 
         # initial grad value
         if self.hparams.automatic_optimization == False:
@@ -403,15 +575,16 @@ class LitModel(pl.LightningModule):
     def compute_loss(self, batch, phase):
 
         targets_OI, inputs_Mask, targets_GT = batch
+        self.solver_diagnostics.phase = phase
         # handle patch with no observation
-        if inputs_Mask.sum().item() == 0:
+        if not self.has_obs(inputs_Mask):
             return (
                 None,
                 torch.zeros_like(targets_GT),
                 dict([('mse', 0.), ('mseGrad', 0.), ('meanGrad', 1.), ('mseOI', 0.),
                       ('mseGOI', 0.)])
             )
-        new_masks = torch.cat((1. + 0. * inputs_Mask, inputs_Mask), dim=1)
+        new_masks = torch.cat((torch.ones_like(targets_OI), inputs_Mask), dim=1)
         targets_GT_wo_nan = targets_GT.where(~targets_GT.isnan(), torch.zeros_like(targets_GT))
         inputs_init = torch.cat((targets_OI, inputs_Mask * (targets_GT_wo_nan - targets_OI)), dim=1)
         inputs_missing = torch.cat((targets_OI, inputs_Mask * (targets_GT_wo_nan - targets_OI)), dim=1)
@@ -437,8 +610,7 @@ class LitModel(pl.LightningModule):
             loss_All = NN_4DVar.compute_WeightedLoss((outputs - targets_GT), self.w_loss)
 
             loss_GAll = NN_4DVar.compute_WeightedLoss(g_outputs - g_targets_GT, self.w_loss)
-            loss_OI = NN_4DVar.compute_WeightedLoss(targets_GT - targets_OI, self.w_loss)
-            loss_GOI = NN_4DVar.compute_WeightedLoss(self.gradient_img(targets_OI) - g_targets_GT, self.w_loss)
+            loss_OI, loss_GOI, mean_GAll = self.baseline_metrics(targets_OI, targets_GT, g_targets_GT, phase)
 
             # projection losses
             loss_AE = torch.mean((self.model.phi_r(outputsSLRHR) - outputsSLRHR) ** 2)
@@ -448,7 +620,7 @@ class LitModel(pl.LightningModule):
 
             # low-resolution loss
             loss_SR = NN_4DVar.compute_WeightedLoss(outputsSLR - targets_OI, self.w_loss)
-            targets_GTLR = self.model_LR(targets_OI)
+            targets_GTLR = self.targets_lr(targets_OI)
             loss_LR = NN_4DVar.compute_WeightedLoss(self.model_LR(outputs) - targets_GTLR, self.w_loss)
 
             # total loss
@@ -457,7 +629,6 @@ class LitModel(pl.LightningModule):
             loss += self.hparams.alpha_lr * loss_LR + self.hparams.alpha_sr * loss_SR
 
             # metrics
-            mean_GAll = NN_4DVar.compute_WeightedLoss(g_targets_GT, self.w_loss)
             mse = loss_All.detach()
             mseGrad = loss_GAll.detach()
             metrics = dict([('mse', mse), ('mseGrad', mseGrad), ('meanGrad', mean_GAll), ('mseOI', loss_OI.detach()),
@@ -544,18 +715,19 @@ class LitModelWithSST(LitModel):
     def compute_loss(self, batch, phase):  ## to be updated
 
         targets_OI, inputs_Mask, targets_GT, sst_GT = batch
+        self.solver_diagnostics.phase = phase
         # handle patch with no observation
-        if inputs_Mask.sum().item() == 0:
+        if not self.has_obs(inputs_Mask):
             return (
                 None,
                 torch.zeros_like(targets_GT),
                 dict([('mse', 0.), ('mseGrad', 0.), ('meanGrad', 1.), ('mseOI', 0.),
                       ('mseGOI', 0.)])
             )
-        new_masks = torch.cat((1. + 0. * inputs_Mask, inputs_Mask), dim=1)
+        new_masks = torch.cat((torch.ones_like(targets_OI), inputs_Mask), dim=1)
         # inputs_init = torch.cat((targets_OI, inputs_Mask * (targets_GT - targets_OI)), dim=1)
         # inputs_missing = torch.cat((targets_OI, inputs_Mask * (targets_GT - targets_OI)), dim=1)
-        mask_SST = 1. + 0. * sst_GT
+        mask_SST = torch.ones_like(sst_GT)
 
         targets_GT_wo_nan = targets_GT.where(~targets_GT.isnan(), torch.zeros_like(targets_GT))
         inputs_init = torch.cat((targets_OI, inputs_Mask * (targets_GT_wo_nan - targets_OI)), dim=1)
@@ -583,8 +755,7 @@ class LitModelWithSST(LitModel):
             loss_All = NN_4DVar.compute_WeightedLoss((outputs - targets_GT), self.w_loss)
             loss_GAll = NN_4DVar.compute_WeightedLoss(g_outputs - g_targets_GT, self.w_loss)
 
-            loss_OI = NN_4DVar.compute_WeightedLoss(targets_GT - targets_OI, self.w_loss)
-            loss_GOI = NN_4DVar.compute_WeightedLoss(self.gradient_img(targets_OI) - g_targets_GT, self.w_loss)
+            loss_OI, loss_GOI, mean_GAll = self.baseline_metrics(targets_OI, targets_GT, g_targets_GT, phase)
 
             # projection losses
             loss_AE = torch.mean((self.model.phi_r(outputsSLRHR) - outputsSLRHR) ** 2)
@@ -594,7 +765,7 @@ class LitModelWithSST(LitModel):
 
             # low-resolution loss
             loss_SR = NN_4DVar.compute_WeightedLoss(outputsSLR - targets_OI, self.w_loss)
-            targets_GTLR = self.model_LR(targets_OI)
+            targets_GTLR = self.targets_lr(targets_OI)
             loss_LR = NN_4DVar.compute_WeightedLoss(self.model_LR(outputs) - targets_GTLR, self.w_loss)
 
             # total loss
@@ -603,7 +774,6 @@ class LitModelWithSST(LitModel):
             loss += self.hparams.alpha_lr * loss_LR + self.hparams.alpha_sr * loss_SR
 
             # metrics
-            mean_GAll = NN_4DVar.compute_WeightedLoss(g_targets_GT, self.w_loss)
             mse = loss_All.detach()
             mseGrad = loss_GAll.detach()
             metrics = dict([('mse', mse), ('mseGrad', mseGrad), ('meanGrad', mean_GAll), ('mseOI', loss_OI.detach()),
@@ -1,15 +1,168 @@
+import atexit
+import json
+import os
+
 import numpy as np
 import pytorch_lightning as pl
+import torch
 import xarray as xr
-from torch.utils.data import Dataset, ConcatDataset, DataLoader
+from pytorch_lightning.utilities import rank_zero_only
+from torch.utils.data import Dataset, ConcatDataset, DataLoader, DistributedSampler
+
+
+def encode_float(x, storage_dtype):
+    """
+    Compact storage of a float array: 'float16', or 'bfloat16' (no numpy type: upper 16 bits of the float32,
+    rounded to nearest even, as int16)
+    """
+    if storage_dtype == 'float16':
+        return x.astype(np.float16)
+    if storage_dtype == 'bfloat16':
+        bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32).astype(np.uint64)
+        bits = (bits + 0x7FFF + ((bits >> 16) & 1)) >> 16
+        return bits.astype(np.uint16).view(np.int16)
+    raise ValueError('Unknown storage dtype %s' % storage_dtype)
+
+
+def decode_float(x, storage_dtype):
+    # float32 tensor of a tensor encoded by encode_float
+    if storage_dtype == 'bfloat16':
+        x = x.view(torch.bfloat16)
+    return x.float()
+
+
+def avg_pool(x, k):
+    """
+    Average pooling of the last two dimensions of x by k x k blocks, as torch.nn.AvgPool2d(k) (remainders dropped)
+    """
+    *lead, h, w = x.shape
+    h, w = h // k * k, w // k * k
+    return x[..., :h, :w].reshape(*lead, h // k, k, w // k, k).mean(axis=(-3, -1))
+
+
+def pack_mask(mask):
+    # boolean array packed into a flat uint8 array, 8 pixels per byte
+    return np.packbits(mask.reshape(-1))
+
+
+def unpack_mask(packed, shape):
+    """
+    :param packed: batch x n_bytes uint8 tensor of masks packed by pack_mask
+    :param shape: shape of an unpacked mask
+    :return: batch x shape boolean tensor
+    """
+    bits = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=packed.device)
+    mask = (packed.unsqueeze(-1) & bits) != 0
+    return mask.flatten(1)[:, :int(np.prod(shape))].view(packed.shape[0], *shape)
+
+
+class BatchTransform:
+    """
+    Restores on the device the batches of a FourDVarNetDataset storing a bit-packed mask and / or compact floats:
+    unpacks the mask and casts the fields back to float32.
+    With raw items, also does the preprocessing of FourDVarNetDataset.__getitem__ on the whole batch:
+    OI outliers and NaNs set to 0 after normalization, GT normalized (NaNs kept), mask of the observed pixels,
+    SST normalized with its NaNs set to 0
+    """
+
+    def __init__(self, pack_mask=False, storage_dtype=None, raw=False, norm_stats=None, norm_stats_sst=None):
+        """
+        :param pack_mask: the mask is bit-packed
+        :param storage_dtype: (Optional) 'float16' / 'bfloat16' storage of the fields
+        :param raw: the items are raw windows (un-normalized fields, observation field with NaNs as mask)
+        :param norm_stats: (mean, std) of the fields, required with raw items
+        :param norm_stats_sst: (mean, std) of the SST, required with raw items and SST
+        """
+        self.pack_mask = pack_mask
+        self.storage_dtype = storage_dtype
+        self.raw = raw
+        self.norm_stats = norm_stats
+        self.norm_stats_sst = norm_stats_sst
+
+    def __call__(self, batch):
+        oi, mask, gt, *other = batch
+        if self.storage_dtype is not None:
+            oi, gt = decode_float(oi, self.storage_dtype), decode_float(gt, self.storage_dtype)
+            other = [decode_float(x, self.storage_dtype) for x in other]
+        if self.pack_mask:
+            mask = unpack_mask(mask, oi.shape[1:])
+        if self.raw:
+            oi, mask, gt, other = self.preprocess(oi, mask, gt, other)
+        return (oi, mask, gt, *other)
+
+    def preprocess(self, oi, mask, gt, other):
+        mean, std = self.norm_stats
+        # outliers and NaNs (abs(NaN) < 10 is False) of the OI are set to 0 once normalized
+        oi = torch.where(oi.abs() < 10, (oi - mean) / std, torch.zeros((), dtype=oi.dtype, device=oi.device))
+        gt = (gt - mean) / std
+        if not self.pack_mask:
+            mask = ~torch.isnan(mask)
+        if other:
+            mean, std = self.norm_stats_sst
+            sst = (other[0] - mean) / std
+            other = [torch.where(torch.isnan(sst), torch.zeros_like(sst), sst)] + list(other[1:])
+        return oi, mask, gt, other
+
+
+# process-local registry of the opened files {(<path>, <decode>): <xarray dataset>}, shared by all the XrDatasets
+_open_files = {}
+_open_files_pid = os.getpid()
+# bumped when the files are closed, XrDatasets then reopen their views
+_open_files_generation = 0
+
+
+def open_dataset(path, decode=False):
+    """
+    xarray dataset of path, opened once per process and shared: datasets opened by a parent process
+    are not reused after a fork
+    :param decode: Whether to decode the time dim (time in seconds since 2012-10-01 without units, eg gt and sst)
+    """
+    if os.getpid() != _open_files_pid:
+        reset_files()
+    key = (path, decode)
+    if key not in _open_files:
+        _ds = xr.open_dataset(path)
+        if decode:
+            _ds.time.attrs["units"] = "seconds since 2012-10-01"
+            _ds = xr.decode_cf(_ds)
+        _open_files[key] = _ds
+    return _open_files[key]
+
+
+def reset_files():
+    """
+    Forget the files opened by the parent process, without closing them (the handles belong to the parent)
+    """
+    global _open_files_pid, _open_files_generation
+    _open_files.clear()
+    _open_files_pid = os.getpid()
+    _open_files_generation += 1
+
+
+def close_files():
+    global _open_files_generation
+    if os.getpid() == _open_files_pid:
+        for _ds in _open_files.values():
+            _ds.close()
+    _open_files.clear()
+    _open_files_generation += 1
+
+
+def worker_init_fn(worker_id):
+    # dataloader workers open their own file handles
+    reset_files()
+
+
+atexit.register(close_files)
 
 
 class XrDataset(Dataset):
     """
     torch Dataset based on an xarray file with on the fly slicing.
+    The file is opened through the process-local registry (open_dataset), the dataset only holds its selection.
     """
 
-    def __init__(self, path, var, slice_win, dim_range=None, strides=None, decode=False):
+    def __init__(self, path, var, slice_win, dim_range=None, strides=None, decode=False, cover=False):
         """
         :param path: xarray file
         :param var: data variable to fetch
@@ -17,39 +170,185 @@ class XrDataset(Dataset):
         :param dim_range: Optional dimensions bounds for each dimension {<dim>: slice(<min>, <max>)...}
         :param strides: strides on each dim while scanning the dataset {<dim>: <dim_stride>...}
         :param decode: Whether to decode the time dim xarray (useful for gt dataset)
+        :param cover: add a last window ending at the end of the dimensions the strides do not fit, so that the
+            windows cover the whole selection (inference)
         """
         super().__init__()
 
+        self.path = path
         self.var = var
-        _ds = xr.open_dataset(path)
-        if decode:
-            _ds.time.attrs["units"] = "seconds since 2012-10-01"
-            _ds = xr.decode_cf(_ds)
-        self.ds = _ds.sel(**(dim_range or {}))
+        self.decode = decode
+        self.dim_range = dim_range
+        self._ds = None
+        self._ds_generation = None
         self.slice_win = slice_win
         self.strides = strides or {}
-        self.ds_size = {
-            dim: max((self.ds.dims[dim] - slice_win[dim]) // self.strides.get(dim, 1) + 1, 0)
-            for dim in slice_win
-        }
-
-    def __del__(self):
-        self.ds.close()
+        # window starts along each dimension
+        dim_starts = {}
+        for dim in slice_win:
+            size, stride = self.ds.dims[dim], self.strides.get(dim, 1)
+            dim_starts[dim] = np.arange(max((size - slice_win[dim]) // stride + 1, 0)) * stride
+            if cover and len(dim_starts[dim]) and dim_starts[dim][-1] + slice_win[dim] < size:
+                dim_starts[dim] = np.append(dim_starts[dim], size - slice_win[dim])
+        self.ds_size = {dim: len(dim_starts[dim]) for dim in slice_win}
+
+        # window start offsets of the items, one row per item, in the order of np.unravel_index
+        starts = np.meshgrid(*dim_starts.values(), indexing='ij')
+        self.index = np.stack([s.ravel() for s in starts], axis=1).astype(np.int32)
+
+    @property
+    def ds(self):
+        # selection of the registry dataset, taken again in a new process or once the files have been closed
+        if self._ds is None or self._ds_generation != _open_files_generation or os.getpid() != _open_files_pid:
+            self._ds = open_dataset(self.path, self.decode).sel(**(self.dim_range or {}))
+            self._ds_generation = _open_files_generation
+        return self._ds
+
+    def __getstate__(self):
+        return {**self.__dict__, '_ds': None}
 
     def __len__(self):
-        size = 1
-        for v in self.ds_size.values():
-            size *= v
-        return size
+        return len(self.index)
+
+    def window(self, item):
+        """
+        :return: index slices of the item window {<dim>: slice(<start>, <stop>)...}
+        """
+        return {dim: slice(int(start), int(start) + self.slice_win[dim])
+                for dim, start in zip(self.ds_size, self.index[item])}
+
+    def read(self, window):
+        """
+        :param window: index slices {<dim>: slice(<start>, <stop>)...}
+        :return: float32 array of the variable window
+        """
+        # indexing the variable directly skips the DataArray / Dataset wrappers of isel
+        var = self.ds.variables[self.var]
+        return np.asarray(var[tuple(window.get(dim, slice(None)) for dim in var.dims)], dtype=np.float32)
 
     def __getitem__(self, item):
-        sl = {
-            dim: slice(self.strides.get(dim, 1) * idx,
-                       self.strides.get(dim, 1) * idx + self.slice_win[dim])
-            for dim, idx in zip(self.ds_size.keys(),
-                                np.unravel_index(item, tuple(self.ds_size.values())))
-        }
-        return self.ds.isel(**sl)[self.var].data.astype(np.float32)
+        return self.read(self.window(item))
+
+
+class IndexedConcatDataset(ConcatDataset):
+    """
+    ConcatDataset looking the items up in a precomputed (dataset, item) table instead of a bisect on every call
+    """
+
+    def __init__(self, datasets, with_index=False):
+        """
+        :param with_index: add 'index': <index of the item> to the extras of the items (dict after their fields,
+            see LitModel.baseline_metrics)
+        """
+        super().__init__(datasets)
+        self.with_index = with_index
+        self.index = np.concatenate(
+            [np.stack([np.full(len(ds), i), np.arange(len(ds))], axis=1) for i, ds in enumerate(self.datasets)]
+            + [np.zeros((0, 2), dtype=np.int64)]
+        ).astype(np.int32)
+
+    def __getitem__(self, idx):
+        ds_idx, item = self.index[idx]
+        item = self.datasets[ds_idx][item]
+        if not self.with_index:
+            return item
+        if isinstance(item[-1], dict):
+            return (*item[:-1], {**item[-1], 'index': idx})
+        return (*item, {'index': idx})
+
+
+def time_blocks(ds, block_time):
+    """
+    :param ds: IndexedConcatDataset of FourDVarNetDatasets
+    :param block_time: number of consecutive time windows of a block
+    :return: (n_blocks x 2) array of the [start, stop) item ranges of the blocks: the items of block_time consecutive
+        time windows of a FourDVarNetDataset (items are ordered by time, then lat, then lon)
+    """
+    blocks, offset = [], 0
+    for _ds in ds.datasets:
+        n_items = len(_ds)
+        per_time = n_items // max(_ds.oi_ds.ds_size['time'], 1)
+        step = max(block_time * per_time, 1)
+        starts = np.arange(offset, offset + n_items, step)
+        blocks.append(np.stack([starts, np.minimum(starts + step, offset + n_items)], axis=1))
+        offset += n_items
+    return np.concatenate(blocks + [np.zeros((0, 2), dtype=np.int64)])
+
+
+class BlockDistributedSampler(DistributedSampler):
+    """
+    DistributedSampler giving each rank contiguous spans of time blocks instead of items scattered over the whole
+    period: the blocks are shuffled every epoch (set_epoch), the sequence of their items is split in one contiguous
+    span per rank and the items are shuffled within their block. The files are then read by each rank over a few time
+    blocks only.
+    The replicas and rank are resolved when sampling, not when the sampler is built: the training dataloader is
+    built before the trainer starts the process group. Without torch.distributed, a single replica is sampled.
+    """
+
+    def __init__(self, dataset, blocks, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=False):
+        """
+        :param dataset: sampled dataset
+        :param blocks: (n_blocks x 2) [start, stop) item ranges covering the dataset, see time_blocks
+        :param num_replicas: (Optional) number of ranks, the world size of the process group by default
+        :param rank: (Optional) rank of the process, the one in the process group by default
+        """
+        # DistributedSampler.__init__ fixes the replicas at construction (or fails without process group)
+        self.dataset = dataset
+        self._num_replicas = num_replicas
+        self._rank = rank
+        self.epoch = 0
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.blocks = np.asarray(blocks, dtype=np.int64)
+
+    @staticmethod
+    def _distributed():
+        return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+    @property
+    def num_replicas(self):
+        if self._num_replicas is not None:
+            return self._num_replicas
+        return torch.distributed.get_world_size() if self._distributed() else 1
+
+    @property
+    def rank(self):
+        if self._rank is not None:
+            return self._rank
+        return torch.distributed.get_rank() if self._distributed() else 0
+
+    @property
+    def num_samples(self):
+        # as DistributedSampler
+        n, num_replicas = len(self.dataset), self.num_replicas
+        if self.drop_last and n % num_replicas != 0:
+            return int(np.ceil((n - num_replicas) / num_replicas))
+        return int(np.ceil(n / num_replicas))
+
+    @property
+    def total_size(self):
+        return self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        order = np.arange(len(self.blocks))
+        if self.shuffle:
+            rng = np.random.RandomState((self.seed + self.epoch) % 2 ** 32)
+            rng.shuffle(order)
+        spans = []
+        for start, stop in self.blocks[order]:
+            items = np.arange(start, stop)
+            if self.shuffle:
+                rng.shuffle(items)
+            spans.append(items)
+        indices = np.concatenate(spans + [np.zeros(0, dtype=np.int64)])
+
+        # same padding / truncation as DistributedSampler, then a contiguous span per rank
+        if not self.drop_last:
+            indices = np.concatenate([indices, np.resize(indices, self.total_size - len(indices))])
+        indices = indices[:self.total_size]
+        rank, num_samples = self.rank, self.num_samples
+        return iter(indices[rank * num_samples:(rank + 1) * num_samples].tolist())
 
 
 class FourDVarNetDataset(Dataset):
@@ -73,24 +372,61 @@ class FourDVarNetDataset(Dataset):
             gt_path='/gpfsstore/rech/yrf/commun/NATL60/NATL/ref/NATL60-CJM165_NATL_ssh_y2013.1y.nc',
             gt_var='ssh',
             sst_path=None,
-            sst_var=None
+            sst_var=None,
+            pack_mask=False,
+            storage_dtype=None,
+            raw=False,
+            oi_lr_pool=None,
+            cover=False,
     ):
         super().__init__()
-
-        self.oi_ds = XrDataset(oi_path, oi_var, slice_win=slice_win, dim_range=dim_range, strides=strides)
-        self.gt_ds = XrDataset(gt_path, gt_var, slice_win=slice_win, dim_range=dim_range, strides=strides, decode=True)
+        # transport the mask bit-packed and the fields as 'float16' / 'bfloat16', restored by BatchTransform
+        self.pack_mask = pack_mask
+        self.storage_dtype = storage_dtype
+        # items are the raw windows, preprocessed on the device by BatchTransform
+        self.raw = raw
+        # (Optional) pooling factor of the low resolution OI added to the extras of the items (16 for models.ModelLR)
+        self.oi_lr_pool = oi_lr_pool
+
+        # cover: last windows clamped to the end of the selection, see XrDataset
+        self.oi_ds = XrDataset(oi_path, oi_var, slice_win=slice_win, dim_range=dim_range, strides=strides,
+                               cover=cover)
+        self.gt_ds = XrDataset(gt_path, gt_var, slice_win=slice_win, dim_range=dim_range, strides=strides, decode=True,
+                               cover=cover)
         self.obs_mask_ds = XrDataset(obs_mask_path, obs_mask_var, slice_win=slice_win, dim_range=dim_range,
-                                     strides=strides)
+                                     strides=strides, cover=cover)
 
         self.norm_stats = None
 
         if sst_var == 'sst':
             self.sst_ds = XrDataset(sst_path, sst_var, slice_win=slice_win, dim_range=dim_range, strides=strides,
-                                    decode=True)
+                                    decode=True, cover=cover)
         else:
             self.sst_ds = None
         self.norm_stats_sst = None
 
+        # the window of an item is looked up once for all the variables when their grids match
+        self._item_ds = [self.oi_ds, self.obs_mask_ds, self.gt_ds] + ([self.sst_ds] if self.sst_ds is not None else [])
+        self._shared_index = all(_ds.ds_size == self.oi_ds.ds_size for _ds in self._item_ds)
+        # (Optional) size of the random crops of the windows served as items {<dim>: <size>...}
+        self.crop = None
+
+    def set_crop(self, crop):
+        """
+        :param crop: size of the random crops of the windows served as items {<dim>: <size>...}, None for the full
+            windows
+        """
+        self.crop = crop
+
+    def _crop_offsets(self):
+        # the torch generator is seeded per worker by the torch and shared-memory loaders
+        return {dim: int(torch.randint(self.oi_ds.slice_win[dim] - size + 1, ()))
+                for dim, size in (self.crop or {}).items()}
+
+    def _cropped(self, window, offsets):
+        return {dim: slice(sl.start + offsets[dim], sl.start + offsets[dim] + self.crop[dim]) if dim in offsets else sl
+                for dim, sl in window.items()}
+
     def set_norm_stats(self, stats, stats_sst=None):
         self.norm_stats = stats
         self.norm_stats_sst = stats_sst
@@ -98,29 +434,63 @@ class FourDVarNetDataset(Dataset):
     def __len__(self):
         return min(len(self.oi_ds), len(self.gt_ds), len(self.obs_mask_ds))
 
+    def read(self, item):
+        """
+        :return: float32 windows of oi, obs mask, gt (and sst) of item, the same random crop of them with crop
+        """
+        offsets = self._crop_offsets()
+        if self._shared_index:
+            window = self._cropped(self.oi_ds.window(item), offsets)
+            return [_ds.read(window) for _ds in self._item_ds]
+        return [_ds.read(self._cropped(_ds.window(item), offsets)) for _ds in self._item_ds]
+
     def __getitem__(self, item):
+        if self.raw:
+            fields = self.read(item)
+            return self._with_extras(self._encode(*fields), fields[0])
         mean, std = self.norm_stats
-        _oi_item = self.oi_ds[item]
+        _oi_item, _obs_mask_item, _gt_item, *_sst_item = self.read(item)
         _oi_item = (np.where(
             np.abs(_oi_item) < 10,
             _oi_item,
             np.nan,
         ) - mean) / std
-        _gt_item = (self.gt_ds[item] - mean) / std
+        _gt_item = (_gt_item - mean) / std
         oi_item = np.where(~np.isnan(_oi_item), _oi_item, 0.)
         # obs_mask_item = self.obs_mask_ds[item].astype(bool) & ~np.isnan(oi_item) & ~np.isnan(_gt_item)
-        obs_mask_item = ~np.isnan(self.obs_mask_ds[item])
+        obs_mask_item = ~np.isnan(_obs_mask_item)
 
         gt_item = _gt_item
 
         if self.sst_ds == None:
-            return oi_item, obs_mask_item, gt_item
+            return self._with_extras(self._encode(oi_item, obs_mask_item, gt_item), oi_item)
         else:
             mean, std = self.norm_stats_sst
-            _sst_item = (self.sst_ds[item] - mean) / std
+            _sst_item = (_sst_item[0] - mean) / std
             sst_item = np.where(~np.isnan(_sst_item), _sst_item, 0.)
 
-            return oi_item, obs_mask_item, gt_item, sst_item
+            return self._with_extras(self._encode(oi_item, obs_mask_item, gt_item, sst_item), oi_item)
+
+    def _with_extras(self, fields, oi_item):
+        """
+        :param oi_item: OI window, raw or preprocessed as in the item
+        :return: fields of the item followed by its extras {'oi_lr': <preprocessed OI average-pooled by oi_lr_pool>},
+            the fields alone without oi_lr_pool
+        """
+        if self.oi_lr_pool is None:
+            return fields
+        if self.raw:
+            mean, std = self.norm_stats
+            oi_item = np.where(np.abs(oi_item) < 10, (oi_item - mean) / std, 0.)
+        return (*fields, {'oi_lr': avg_pool(oi_item, self.oi_lr_pool).astype(np.float32)})
+
+    def _encode(self, oi_item, obs_mask_item, gt_item, *other):
+        if self.pack_mask:
+            obs_mask_item = pack_mask(~np.isnan(obs_mask_item) if self.raw else obs_mask_item)
+        if self.storage_dtype is not None:
+            oi_item, gt_item = encode_float(oi_item, self.storage_dtype), encode_float(gt_item, self.storage_dtype)
+            other = [encode_float(x, self.storage_dtype) for x in other]
+        return (oi_item, obs_mask_item, gt_item, *other)
 
 
 class FourDVarNetDataModule(pl.LightningDataModule):
@@ -143,13 +513,21 @@ class FourDVarNetDataModule(pl.LightningDataModule):
             sst_path=None,
             sst_var=None,
             dl_kwargs=None,
+            norm_stats_path=None,
+            loader='torch',
+            pack_mask=False,
+            storage_dtype=None,
+            raw_items=False,
+            block_time=None,
+            item_index=False,
+            oi_lr_pool=None,
     ):
         super().__init__()
         self.slice_win = slice_win
         self.dim_range = dim_range
         self.strides = strides
         self.dl_kwargs = {
-            **{'batch_size': 2, 'num_workers': 2, 'pin_memory': True},
+            **{'batch_size': 2, 'num_workers': 2, 'pin_memory': True, 'worker_init_fn': worker_init_fn},
             **(dl_kwargs or {})
         }
 
@@ -164,8 +542,39 @@ class FourDVarNetDataModule(pl.LightningDataModule):
 
         self.train_slices, self.test_slices, self.val_slices = train_slices, test_slices, val_slices
         self.train_ds, self.val_ds, self.test_ds = None, None, None
+        # 'torch' DataLoader or 'shm' SharedMemoryLoader (shared-memory batch slots, pinned double buffering)
+        self.loader = loader
+        # bit-packed mask and 'float16' / 'bfloat16' fields in the batches, see batch_transform
+        self.pack_mask = pack_mask
+        self.storage_dtype = storage_dtype
+        # raw windows in the batches, cleaned and normalized on the device by batch_transform
+        self.raw_items = raw_items
+        # training items sampled by blocks of block_time consecutive time windows, see BlockDistributedSampler
+        self.block_time = block_time
+        # dataset index of the items in the batches, the model caches the baseline metrics of the patches with it
+        self.item_index = item_index
+        # low resolution OI target of the loss computed by the workers, see FourDVarNetDataset
+        self.oi_lr_pool = oi_lr_pool
+        # size (lat and lon) of the random crops of the training patches, None for the full patches
+        self.patch_size = None
+        # (Optional) batch size of the training dataloader only (cropped patches), dl_kwargs batch_size otherwise
+        self.train_batch_size = None
+        # json cache of the training set normalization stats, reused as long as the data config doesn't change
+        self.norm_stats_path = norm_stats_path
         self.norm_stats = None
         self.norm_stats_sst = None
+        self.bounding_box = None
+        self.ds_size = None
+
+    # splits built by each setup stage
+    stage_splits = {
+        None: ('train', 'val', 'test'),
+        'fit': ('train', 'val'),
+        'train': ('train',),
+        'val': ('val',),
+        'validate': ('val',),
+        'test': ('test',),
+    }
 
     def compute_norm_stats(self, ds):
         mean = float(xr.concat([_ds.gt_ds.ds[_ds.gt_ds.var] for _ds in ds.datasets], dim='time').mean())
@@ -180,6 +589,47 @@ class FourDVarNetDataModule(pl.LightningDataModule):
 
             return [mean, std], [mean_sst, std_sst]
 
+    def _norm_stats_key(self):
+        """
+        Data config the cached normalization stats depend on
+        """
+        return {
+            'gt': [self.gt_path, self.gt_var],
+            'sst': [self.sst_path, self.sst_var],
+            'dim_range': {dim: [str(sl.start), str(sl.stop)] for dim, sl in (self.dim_range or {}).items()},
+            'train_slices': [[str(sl.start), str(sl.stop)] for sl in self.train_slices],
+        }
+
+    def load_norm_stats(self):
+        """
+        :return: cached (norm_stats, norm_stats_sst) or None if there is no cache matching the data config
+        """
+        if self.norm_stats_path is None or not os.path.isfile(self.norm_stats_path):
+            return None
+        try:
+            with open(self.norm_stats_path) as f:
+                cache = json.load(f)
+        except ValueError:
+            print('... Ignore norm stats cache %s: not readable' % self.norm_stats_path)
+            return None
+        if cache.get('key') != self._norm_stats_key():
+            print('... Ignore norm stats cache %s: computed on another data config' % self.norm_stats_path)
+            return None
+        return cache['norm_stats'], cache['norm_stats_sst']
+
+    def save_norm_stats(self):
+        # written by the global rank 0 only, and renamed once complete: the other ranks never read a partial file
+        if self.norm_stats_path is None or rank_zero_only.rank != 0:
+            return
+        tmp_path = '%s.%d.tmp' % (self.norm_stats_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'key': self._norm_stats_key(),
+                'norm_stats': list(self.norm_stats),
+                'norm_stats_sst': None if self.norm_stats_sst is None else list(self.norm_stats_sst),
+            }, f, indent=2)
+        os.replace(tmp_path, self.norm_stats_path)
+
     def set_norm_stats(self, ds, ns, ns_sst=None):
         for _ds in ds.datasets:
             _ds.set_norm_stats(ns, ns_sst)
@@ -192,51 +642,139 @@ class FourDVarNetDataModule(pl.LightningDataModule):
         return min_lon, max_lon, min_lat, max_lat
 
     def get_domain_split(self):
-        return self.test_ds.datasets[0].gt_ds.ds_size
+        ds = next(_ds for _ds in (self.test_ds, self.val_ds, self.train_ds) if _ds is not None)
+        return ds.datasets[0].gt_ds.ds_size
 
-    def setup(self, stage=None):
-        self.train_ds, self.val_ds, self.test_ds = [
-            ConcatDataset(
-                [FourDVarNetDataset(
-                    dim_range={**self.dim_range, **{'time': sl}},
-                    strides=self.strides,
-                    slice_win=self.slice_win,
-                    oi_path=self.oi_path,
-                    oi_var=self.oi_var,
-                    obs_mask_path=self.obs_mask_path,
-                    obs_mask_var=self.obs_mask_var,
-                    gt_path=self.gt_path,
-                    gt_var=self.gt_var,
-                    sst_path=self.sst_path,
-                    sst_var=self.sst_var
-                ) for sl in slices]
-            )
-            for slices in (self.train_slices, self.val_slices, self.test_slices)
-        ]
+    def build_ds(self, slices, dim_range=None, slice_win=None, strides=None, cover=False):
+        """
+        :param slices: time slices of the dataset
+        :param dim_range: (Optional) spatial bounds, defaults to the datamodule dim_range
+        :param slice_win: (Optional) patch size, defaults to the datamodule slice_win
+        :param strides: (Optional) patch strides, defaults to the datamodule strides
+        :param cover: add last patches clamped to the end of the dimensions the strides do not fit (inference)
+        """
+        return IndexedConcatDataset(
+            [FourDVarNetDataset(
+                dim_range={**(dim_range or self.dim_range), **{'time': sl}},
+                strides=strides or self.strides,
+                slice_win=slice_win or self.slice_win,
+                oi_path=self.oi_path,
+                oi_var=self.oi_var,
+                obs_mask_path=self.obs_mask_path,
+                obs_mask_var=self.obs_mask_var,
+                gt_path=self.gt_path,
+                gt_var=self.gt_var,
+                sst_path=self.sst_path,
+                sst_var=self.sst_var,
+                pack_mask=self.pack_mask,
+                storage_dtype=self.storage_dtype,
+                raw=self.raw_items,
+                oi_lr_pool=self.oi_lr_pool,
+                cover=cover,
+            ) for sl in slices],
+            with_index=self.item_index,
+        )
+
+    def batch_transform(self):
+        """
+        :return: BatchTransform restoring the batches on the device, None if they need none
+        """
+        if not self.pack_mask and self.storage_dtype is None and not self.raw_items:
+            return None
+        return BatchTransform(self.pack_mask, self.storage_dtype, raw=self.raw_items,
+                              norm_stats=self.norm_stats, norm_stats_sst=self.norm_stats_sst)
 
+    def setup_norm_stats(self):
+        """
+        Set the normalization stats if they are not set yet: from the norm_stats_path cache,
+        or computed on the training set (which is opened for the occasion)
+        """
+        if self.norm_stats is not None and (self.sst_var is None or self.norm_stats_sst is not None):
+            return
+        cached = self.load_norm_stats()
+        if cached is not None:
+            self.norm_stats, self.norm_stats_sst = cached
+            return
+        train_ds = self.train_ds if self.train_ds is not None else self.build_ds(self.train_slices)
         if self.sst_var == None:
-            self.norm_stats = self.compute_norm_stats(self.train_ds)
-            self.set_norm_stats(self.train_ds, self.norm_stats)
-            self.set_norm_stats(self.val_ds, self.norm_stats)
-            self.set_norm_stats(self.test_ds, self.norm_stats)
+            self.norm_stats = self.compute_norm_stats(train_ds)
         else:
-            self.norm_stats, self.norm_stats_sst = self.compute_norm_stats(self.train_ds)
+            self.norm_stats, self.norm_stats_sst = self.compute_norm_stats(train_ds)
+        self.save_norm_stats()
 
-            self.set_norm_stats(self.train_ds, self.norm_stats, self.norm_stats_sst)
-            self.set_norm_stats(self.val_ds, self.norm_stats, self.norm_stats_sst)
-            self.set_norm_stats(self.test_ds, self.norm_stats, self.norm_stats_sst)
+    def setup(self, stage=None):
+        """
+        Build the datasets of the splits used by stage, the other splits are not opened.
+        The normalization stats are taken in order from: norm_stats set beforehand (eg from a checkpoint),
+        the norm_stats_path cache, a scan of the training set
+        :param stage: None (all splits), 'fit' (train and val), 'train', 'val'/'validate' or 'test'
+        """
+        splits = self.stage_splits[stage]
+        for split in splits:
+            if getattr(self, split + '_ds') is None:
+                setattr(self, split + '_ds', self.build_ds(getattr(self, split + '_slices')))
+
+        self.setup_norm_stats()
+        for split in splits:
+            self.set_norm_stats(getattr(self, split + '_ds'), self.norm_stats, self.norm_stats_sst)
+        self.set_patch_size(self.patch_size)
 
-        self.bounding_box = self.get_domain_bounds(self.train_ds)
+        self.bounding_box = self.get_domain_bounds(getattr(self, splits[0] + '_ds'))
         self.ds_size = self.get_domain_split()
 
+    @property
+    def batch_size(self):
+        return self.dl_kwargs['batch_size']
+
+    def set_batch_size(self, batch_size):
+        # used by the dataloaders built from then on
+        self.dl_kwargs['batch_size'] = batch_size
+
+    def set_train_batch_size(self, batch_size):
+        """
+        Batch size of the training dataloaders built from then on, the val and test ones keep batch_size
+        (None: batch_size for all of them)
+        """
+        self.train_batch_size = batch_size
+
+    def set_patch_size(self, patch_size):
+        """
+        Serve random patch_size x patch_size (lat x lon) crops of the training patches, the full patches with None
+        (used by the dataloaders built from then on, the val and test patches are not cropped)
+        """
+        self.patch_size = patch_size
+        if self.train_ds is None:
+            return
+        crop = None if patch_size is None else {
+            dim: min(patch_size, self.slice_win[dim]) for dim in ('lat', 'lon')}
+        for _ds in self.train_ds.datasets:
+            _ds.set_crop(crop)
+        # the cropped patches change every epoch: their baseline metrics cannot be cached by index
+        self.train_ds.with_index = self.item_index and patch_size is None
+
+    def teardown(self, stage=None):
+        # the datasets reopen their files if they are used again
+        close_files()
+
+    def _dataloader(self, ds, shuffle, sampler=None, batch_size=None):
+        dl_kwargs = {**self.dl_kwargs, **({} if batch_size is None else {'batch_size': batch_size})}
+        if self.loader == 'shm':
+            from shm_loader import SharedMemoryLoader
+
+            return SharedMemoryLoader(ds, **dl_kwargs, shuffle=shuffle, sampler=sampler)
+        return DataLoader(ds, **dl_kwargs, shuffle=shuffle and sampler is None, sampler=sampler)
+
     def train_dataloader(self):
-        return DataLoader(self.train_ds, **self.dl_kwargs, shuffle=True)
+        if self.block_time is None:
+            return self._dataloader(self.train_ds, shuffle=True, batch_size=self.train_batch_size)
+        sampler = BlockDistributedSampler(self.train_ds, time_blocks(self.train_ds, self.block_time), shuffle=True)
+        return self._dataloader(self.train_ds, shuffle=True, sampler=sampler, batch_size=self.train_batch_size)
 
     def val_dataloader(self):
-        return DataLoader(self.val_ds, **self.dl_kwargs, shuffle=False)
+        return self._dataloader(self.val_ds, shuffle=False)
 
     def test_dataloader(self):
-        return DataLoader(self.test_ds, **self.dl_kwargs, shuffle=False)
+        return self._dataloader(self.test_ds, shuffle=False)
 
 
 if __name__ == '__main__':
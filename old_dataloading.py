@@ -13,7 +13,10 @@ class LegacyDataLoading(pl.LightningDataModule):
     this file is to be deleted as soon as we tested that the new dataloading utilities are OK
     """
     def __init__(self, cfg):
+        super().__init__()
         self.cfg = cfg
+        self.batch_size = cfg.batch_size
+        self.dl_kwargs = {'num_workers': 4, 'pin_memory': True}
         self.var_Tr = None
         self.var_Tt = None
         self.var_Val = None
@@ -223,15 +226,15 @@ class LegacyDataLoading(pl.LightningDataModule):
         self.mean_Val = np.mean(x_val)
 
 
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
     def train_dataloader(self):
-        return DataLoader(self.training_dataset, batch_size=self.cfg.batch_size, shuffle=True,
-                                    num_workers=4, pin_memory=True)
+        return DataLoader(self.training_dataset, batch_size=self.batch_size, shuffle=True, **self.dl_kwargs)
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.cfg.batch_size, shuffle=False,
-                                    num_workers=4, pin_memory=True)
+        return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False, **self.dl_kwargs)
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.cfg.batch_size, shuffle=False,
-                                    num_workers=4, pin_memory=True)
+        return DataLoader(self.test_dataset, batch_size=self.batch_size, shuffle=False, **self.dl_kwargs)
 
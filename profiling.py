@@ -0,0 +1,236 @@
+"""
+Profiling of a fixed number of training steps with the torch profiler, on CPU-only nodes as well as on GPU.
+
+The forward and backward passes of named solver submodules are wrapped in profiler ranges
+(`<module>` and `<module>.backward`) so that time and memory can be attributed to them per solver iteration.
+Exports a chrome trace (chrome://tracing, https://ui.perfetto.dev), collapsed stacks for flamegraphs
+(`flamegraph.pl --countname=us stacks_cpu.txt > flame_cpu.svg`) and text summaries.
+"""
+import itertools
+import os
+import time
+
+import torch
+from pytorch_lightning.utilities.apply_func import move_data_to_device
+from torch.autograd.profiler import record_function
+
+# submodules of Solver_Grad_4DVarNN profiled by default
+SOLVER_MODULES = (
+    'phi_r.encoder.NNLR',
+    'phi_r.encoder.NNHR',
+    'model_Grad.lstm',
+    'model_VarCost',
+    'model_H',
+)
+
+
+class _BackwardRange:
+    """
+    Profiler range covering the backward of one module call: opened when the gradient reaches
+    the module outputs, closed when it reaches the module inputs
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rf = None
+        self.closed = False
+
+    def open(self):
+        if self.rf is None and not self.closed:
+            self.rf = record_function(self.name)
+            self.rf.__enter__()
+
+    def close(self):
+        if self.rf is not None and not self.closed:
+            self.rf.__exit__(None, None, None)
+            self.closed = True
+
+
+class _BackwardMark(torch.autograd.Function):
+    """
+    Identity on tensors, its backward opens or closes a _BackwardRange
+    """
+
+    @staticmethod
+    def forward(ctx, rng, opening, *tensors):
+        ctx.rng, ctx.opening = rng, opening
+        return tuple(t.view_as(t) for t in tensors)
+
+    @staticmethod
+    def backward(ctx, *grads):
+        if ctx.opening:
+            ctx.rng.open()
+        else:
+            ctx.rng.close()
+        return (None, None) + grads
+
+
+def _mark(tensors, rng, opening):
+    """
+    :return: tensors with the tensors requiring grad going through _BackwardMark, whether any of them did
+    """
+    single = torch.is_tensor(tensors)
+    tensors = (tensors,) if single else tensors
+    if not isinstance(tensors, tuple):
+        return tensors, False
+    idx = [i for i, t in enumerate(tensors) if torch.is_tensor(t) and t.requires_grad]
+    if not idx or not torch.is_grad_enabled():
+        return tensors[0] if single else tensors, False
+    marked = _BackwardMark.apply(rng, opening, *(tensors[i] for i in idx))
+    tensors = list(tensors)
+    for i, t in zip(idx, marked):
+        tensors[i] = t
+    return tensors[0] if single else tuple(tensors), True
+
+
+class ModuleRanges:
+    """
+    Forward and backward profiler ranges around named submodules
+    """
+
+    def __init__(self, model, names=SOLVER_MODULES):
+        """
+        :param model: module whose submodules are profiled
+        :param names: names of the submodules, as in model.named_modules()
+        """
+        modules = dict(model.named_modules())
+        unknown = [n for n in names if n not in modules]
+        if unknown:
+            raise ValueError('Unknown modules %s, available: %s' % (unknown, ', '.join(n for n in modules if n)))
+        self.names = tuple(names)
+        self._stack = {name: [] for name in names}
+        self._handles = []
+        for name in names:
+            self._handles.append(modules[name].register_forward_pre_hook(self._pre_hook(name)))
+            self._handles.append(modules[name].register_forward_hook(self._hook(name)))
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            rng = _BackwardRange(name + '.backward')
+            inputs, marked = _mark(inputs, rng, opening=False)
+            rf = record_function(name)
+            rf.__enter__()
+            self._stack[name].append((rf, rng if marked else None))
+            return inputs
+        return hook
+
+    def _hook(self, name):
+        def hook(module, inputs, outputs):
+            rf, rng = self._stack[name].pop()
+            rf.__exit__(None, None, None)
+            if rng is not None:
+                outputs, _ = _mark(outputs, rng, opening=True)
+            return outputs
+        return hook
+
+    def remove(self):
+        for h in self._handles:
+            h.remove()
+        self._handles = []
+
+
+def _device_time(evt):
+    return getattr(evt, 'device_time_total', getattr(evt, 'cuda_time_total', 0.))
+
+
+def _device_memory(evt):
+    return getattr(evt, 'device_memory_usage', getattr(evt, 'cuda_memory_usage', 0))
+
+
+def module_summary(prof, names, n_iter):
+    """
+    :param prof: torch profiler run with ModuleRanges
+    :param names: profiled module names
+    :param n_iter: number of solver iterations profiled
+    :return: table of the time and memory of each module pass per solver iteration
+    """
+    events = {evt.key: evt for evt in prof.key_averages()}
+    lines = ['%-30s %8s %14s %14s %14s %14s' % ('module', 'calls/it', 'cpu ms/it', 'device ms/it', 'cpu MB/it',
+                                                'device MB/it')]
+    for name in names:
+        for key in (name, name + '.backward'):
+            evt = events.get(key)
+            if evt is None:
+                continue
+            lines.append('%-30s %8.1f %14.3f %14.3f %14.2f %14.2f' % (
+                key, evt.count / n_iter, evt.cpu_time_total / 1e3 / n_iter, _device_time(evt) / 1e3 / n_iter,
+                evt.cpu_memory_usage / 2 ** 20 / n_iter, _device_memory(evt) / 2 ** 20 / n_iter))
+    return '\n'.join(lines)
+
+
+def profile(model, batches, steps=5, warmup=2, modules=SOLVER_MODULES, out_dir='profile', with_stack=True):
+    """
+    Profile steps training steps (compute_loss, backward, optimizer step) of a lightning module, without trainer
+    :param model: LitModel on its device
+    :param batches: iterable of batches, cycled over
+    :param steps: number of profiled steps
+    :param warmup: number of steps run before profiling
+    :param modules: solver submodules to attribute time and memory to
+    :param out_dir: directory of the exported files
+    :param with_stack: record the python stacks, required for the flamegraphs
+    :return: the profiler
+    """
+    from torch.profiler import ProfilerActivity
+
+    os.makedirs(out_dir, exist_ok=True)
+    device = model.device
+    opt = model.configure_optimizers()
+    opt = opt[0] if isinstance(opt, (list, tuple)) else opt
+    model.train()
+    model.model.n_grad = model.hparams.n_grad
+    batches = itertools.cycle(batches)
+
+    def _step(i):
+        batch = model.on_before_batch_transfer(next(batches), 0)
+        with record_function('h2d'):
+            batch = model.on_after_batch_transfer(move_data_to_device(batch, device), 0)
+        with record_function('forward'):
+            loss, _, _ = model.compute_loss(batch, phase='train')
+        if loss is None:
+            return
+        with record_function('backward'):
+            loss.backward()
+        with record_function('optimizer'):
+            opt.step()
+            opt.zero_grad()
+
+    print('... Profile %d steps (+%d warmup) on %s, n_grad=%d' % (steps, warmup, device, model.model.n_grad))
+    for i in range(warmup):
+        _step(i)
+
+    activities = [ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(ProfilerActivity.CUDA)
+    kwargs = {}
+    if with_stack and hasattr(torch._C._profiler, '_ExperimentalConfig'):
+        # recent torch versions only export the stacks in verbose mode
+        kwargs['experimental_config'] = torch._C._profiler._ExperimentalConfig(verbose=True)
+    ranges = ModuleRanges(model.model, modules)
+    t0 = time.time()
+    try:
+        with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True,
+                                    with_stack=with_stack, **kwargs) as prof:
+            for i in range(steps):
+                with record_function('step'):
+                    _step(i)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+    finally:
+        ranges.remove()
+    print('..... %.2fs/step (with profiling overhead)' % ((time.time() - t0) / steps))
+
+    prof.export_chrome_trace(os.path.join(out_dir, 'trace.json'))
+    if with_stack:
+        prof.export_stacks(os.path.join(out_dir, 'stacks_cpu.txt'), 'self_cpu_time_total')
+        if device.type == 'cuda':
+            prof.export_stacks(os.path.join(out_dir, 'stacks_cuda.txt'), 'self_cuda_time_total')
+    sort_by = 'self_cuda_time_total' if device.type == 'cuda' else 'self_cpu_time_total'
+    ops = prof.key_averages().table(sort_by=sort_by, row_limit=40)
+    modules_table = module_summary(prof, modules, steps * model.model.n_grad)
+    with open(os.path.join(out_dir, 'ops.txt'), 'w') as f:
+        f.write(ops)
+    with open(os.path.join(out_dir, 'modules.txt'), 'w') as f:
+        f.write(modules_table)
+    print(modules_table)
+    print('*** Profile written to %s ***' % out_dir)
+    return prof
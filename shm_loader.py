@@ -0,0 +1,292 @@
+"""
+Batch loader over a map-style dataset in which worker processes write the items straight into a preallocated
+shared-memory ring of batch slots: no pickling of the items and no collation, only slot numbers go through the queues.
+The main process copies the ready slots into two alternating pinned buffers and issues the device copy of the next
+batch on a side cuda stream while the current batch is being used.
+"""
+import multiprocessing as mp
+import queue
+import traceback
+import weakref
+
+import numpy as np
+import torch
+
+
+def _flatten(item):
+    """
+    :return: leaves (arrays) of an item made of nested tuples / lists / dicts, structure to rebuild it
+    """
+    if isinstance(item, (tuple, list)):
+        leaves, structure = [], []
+        for x in item:
+            _leaves, _structure = _flatten(x)
+            leaves += _leaves
+            structure.append(_structure)
+        return leaves, (type(item), structure)
+    if isinstance(item, dict):
+        leaves, structure = _flatten(list(item.values()))
+        return leaves, (dict, (list(item.keys()), structure))
+    return [item], None
+
+
+def _unflatten(structure, leaves):
+    leaves = iter(leaves)
+
+    def _build(s):
+        if s is None:
+            return next(leaves)
+        kind, content = s
+        if kind is dict:
+            keys, values = content
+            return dict(zip(keys, _build(values)))
+        return kind(_build(c) for c in content)
+
+    return _build(structure)
+
+
+def _fill(dataset, buffers, slot, indices):
+    for i, idx in enumerate(indices):
+        for buf, leaf in zip(buffers, _flatten(dataset[idx])[0]):
+            buf[slot, i].copy_(torch.as_tensor(np.ascontiguousarray(leaf)))
+
+
+def _worker_loop(worker_id, dataset, buffers, tasks, done, worker_init_fn, seed):
+    torch.set_num_threads(1)
+    np.random.seed((seed + worker_id) % 2 ** 32)
+    torch.manual_seed(seed + worker_id)
+    if worker_init_fn is not None:
+        worker_init_fn(worker_id)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        tag, batch_idx, slot, indices = task
+        try:
+            _fill(dataset, buffers, slot, indices)
+            done.put((tag, batch_idx, slot, len(indices), None))
+        except Exception:
+            done.put((tag, batch_idx, slot, 0, traceback.format_exc()))
+
+
+def _shutdown(workers, tasks):
+    for _ in workers:
+        tasks.put(None)
+    for w in workers:
+        w.join(timeout=5)
+        if w.is_alive():
+            w.terminate()
+
+
+class SharedMemoryLoader:
+    """
+    Drop-in replacement of DataLoader(dataset, batch_size, shuffle, num_workers, pin_memory) for datasets
+    whose items are fixed-shape arrays (or tuples / dicts of them). Workers are started on the first iteration
+    and kept for the following epochs. Under torch.distributed, each rank iterates over its share of the items.
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, num_workers=2, pin_memory=True, drop_last=False,
+                 n_slots=None, device=None, worker_init_fn=None, seed=0, timeout=600, sampler=None):
+        """
+        :param dataset: map-style dataset
+        :param batch_size: items per batch
+        :param shuffle: reshuffle the items every epoch
+        :param num_workers: worker processes, 0 to load in the main process
+        :param pin_memory: copy the batches into pinned buffers and on the current cuda device (if available)
+        :param drop_last: drop the last incomplete batch
+        :param n_slots: batches in the shared-memory ring, 2 per worker by default
+        :param device: (Optional) device of the yielded batches, the current cuda device if pin_memory and cuda is
+            available, the cpu otherwise
+        :param worker_init_fn: (Optional) called with the worker id at the start of each worker
+        :param seed: seed of the shuffling (combined with the epoch) and of the workers
+        :param timeout: seconds to wait for a batch before giving up
+        :param sampler: (Optional) sampler of the items of this process, replaces shuffle and the rank sharding,
+            its set_epoch is called every epoch
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.drop_last = drop_last
+        self.n_slots = n_slots or max(2 * num_workers, 1)
+        self.device = device
+        self.worker_init_fn = worker_init_fn
+        self.seed = seed
+        self.timeout = timeout
+        self.sampler = sampler
+        self.epoch = 0
+
+        leaves, self.structure = _flatten(dataset[0])
+        leaves = [torch.as_tensor(np.ascontiguousarray(x)) for x in leaves]
+        self.buffers = [torch.empty((self.n_slots, batch_size) + tuple(x.shape), dtype=x.dtype).share_memory_()
+                        for x in leaves]
+        self._workers = []
+        self._tasks = self._done = None
+        self._in_flight = 0
+        self._pinned = None
+        self._pinned_events = [None, None]
+
+    def _rank_share(self):
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def _indices(self):
+        if self.sampler is not None:
+            if hasattr(self.sampler, 'set_epoch'):
+                self.sampler.set_epoch(self.epoch)
+            return list(self.sampler)
+        n = len(self.dataset)
+        if self.shuffle:
+            indices = np.random.RandomState(self.seed + self.epoch).permutation(n)
+        else:
+            indices = np.arange(n)
+        rank, world_size = self._rank_share()
+        if world_size > 1:
+            # same padding and interleaving as DistributedSampler
+            total = int(np.ceil(n / world_size)) * world_size
+            indices = np.concatenate([indices, indices[:total - n]])[rank::world_size]
+        return indices.tolist()
+
+    def __len__(self):
+        rank, world_size = self._rank_share()
+        n = int(np.ceil(len(self.dataset) / world_size)) if self.sampler is None else len(self.sampler)
+        return n // self.batch_size if self.drop_last else int(np.ceil(n / self.batch_size))
+
+    def _start(self):
+        if self._workers or self.num_workers == 0:
+            return
+        # fork shares the opened dataset with the workers without pickling it
+        ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        self._tasks, self._done = ctx.Queue(), ctx.Queue()
+        self._workers = [
+            ctx.Process(target=_worker_loop, daemon=True,
+                        args=(i, self.dataset, self.buffers, self._tasks, self._done, self.worker_init_fn, self.seed))
+            for i in range(self.num_workers)
+        ]
+        for w in self._workers:
+            w.start()
+        self._finalizer = weakref.finalize(self, _shutdown, self._workers, self._tasks)
+
+    def close(self):
+        if self._workers:
+            self._finalizer()
+            self._workers = []
+
+    def _drain(self):
+        # batches still in flight from an interrupted epoch
+        while self._in_flight:
+            self._get()
+
+    def _get(self):
+        try:
+            msg = self._done.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError('SharedMemoryLoader: no batch received in %ds' % self.timeout)
+        self._in_flight -= 1
+        if msg[4] is not None:
+            raise RuntimeError('SharedMemoryLoader worker failed:\n%s' % msg[4])
+        return msg
+
+    def _slots(self, batches, tag):
+        """
+        :return: generator of (slot, n_items) of the batches, in order
+        """
+        if self.num_workers == 0:
+            for indices in batches:
+                _fill(self.dataset, self.buffers, 0, indices)
+                yield 0, len(indices)
+            return
+
+        free = list(range(self.n_slots))
+        ready = {}
+        next_task = 0
+        for k in range(len(batches)):
+            while free and next_task < len(batches):
+                self._tasks.put((tag, next_task, free.pop(), batches[next_task]))
+                self._in_flight += 1
+                next_task += 1
+            while k not in ready:
+                msg_tag, batch_idx, slot, n, _ = self._get()
+                if msg_tag != tag:
+                    free.append(slot)
+                    continue
+                ready[batch_idx] = (slot, n)
+            slot, n = ready.pop(k)
+            yield slot, n
+            # the slot content has been copied out when the generator resumes
+            free.append(slot)
+
+    def _host_batch(self, slot, n, k):
+        """
+        Copy a slot out of the ring: into the k % 2 pinned buffer, or into new tensors
+        """
+        if self._pinned is None:
+            return [buf[slot, :n].clone() for buf in self.buffers]
+        event = self._pinned_events[k % 2]
+        if event is not None:
+            # previous device copy from this buffer
+            event.synchronize()
+        pinned = [p[:n] for p in self._pinned[k % 2]]
+        for p, buf in zip(pinned, self.buffers):
+            p.copy_(buf[slot, :n])
+        return pinned
+
+    def __iter__(self):
+        device = self.device
+        if device is None and self.pin_memory and torch.cuda.is_available():
+            device = torch.device('cuda', torch.cuda.current_device())
+        device = None if device is None else torch.device(device)
+        cuda = device is not None and device.type == 'cuda'
+        if cuda and self._pinned is None:
+            self._pinned = [[torch.empty(buf.shape[1:], dtype=buf.dtype).pin_memory() for buf in self.buffers]
+                            for _ in range(2)]
+
+        self._start()
+        self._drain()
+        indices = self._indices()
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        self.epoch += 1
+        tag = self.epoch
+
+        if not cuda:
+            for slot, n in self._slots(batches, tag):
+                leaves = self._host_batch(slot, n, 0)
+                if device is not None:
+                    leaves = [x.to(device) for x in leaves]
+                yield _unflatten(self.structure, leaves)
+            return
+
+        stream = torch.cuda.Stream(device)
+
+        def _to_device(k, slot, n):
+            host = self._host_batch(slot, n, k)
+            with torch.cuda.stream(stream):
+                leaves = [x.to(device, non_blocking=True) for x in host]
+                event = torch.cuda.Event()
+                event.record(stream)
+            self._pinned_events[k % 2] = event
+            return leaves, event
+
+        slots = self._slots(batches, tag)
+        pending = None
+        for k, (slot, n) in enumerate(slots):
+            # issue the copy of batch k before handing out batch k - 1
+            current = pending
+            pending = _to_device(k, slot, n)
+            if current is not None:
+                yield self._ready(current, device)
+        if pending is not None:
+            yield self._ready(pending, device)
+
+    def _ready(self, pending, device):
+        leaves, event = pending
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_event(event)
+        for x in leaves:
+            # allocated on the side stream, used on the current one
+            x.record_stream(current_stream)
+        return _unflatten(self.structure, leaves)
@@ -6,6 +6,8 @@ Created on Fri May  1 15:38:05 2020
 @author: rfablet
 """
 
+import time
+
 import numpy as np
 import torch
 from torch import nn
@@ -114,15 +116,23 @@ def compute_WeightedLoss(x2,w):
     return loss2
 
 
+def _per_sample_norm(loss_, x, w):
+    # loss_: batch x channel sums over the pixels, norm of each sample as if it was the whole batch
+    loss_ = torch.nansum( loss_ * w , dim = 1)
+    return loss_ / (torch.sum(~torch.isnan(x), dim = (1, 2, 3)) / x.shape[1] )
+
 # Modules for the definition of the norms for
 # the observation and prior model
+# (per_sample: norm of each sample of the batch, computed in a single batched reduction)
 class Model_WeightedL2Norm(torch.nn.Module):
     def __init__(self):
         super(Model_WeightedL2Norm, self).__init__()
  
-    def forward(self,x,w,eps=0.):
+    def forward(self,x,w,eps=0.,per_sample=False):
         loss_ = torch.nansum( x**2 , dim = 3)
         loss_ = torch.nansum( loss_ , dim = 2)
+        if per_sample:
+            return _per_sample_norm(loss_, x, w)
         loss_ = torch.nansum( loss_ , dim = 0)
         loss_ = torch.nansum( loss_ * w )
         loss_ = loss_ / (torch.sum(~torch.isnan(x)) / x.shape[1] )
@@ -133,10 +143,12 @@ class Model_WeightedL1Norm(torch.nn.Module):
     def __init__(self):
         super(Model_WeightedL1Norm, self).__init__()
  
-    def forward(self,x,w,eps):
+    def forward(self,x,w,eps,per_sample=False):
 
         loss_ = torch.nansum( torch.sqrt( eps**2 + x**2 ) , dim = 3)
         loss_ = torch.nansum( loss_ , dim = 2)
+        if per_sample:
+            return _per_sample_norm(loss_, x, w)
         loss_ = torch.nansum( loss_ , dim = 0)
         loss_ = torch.nansum( loss_ * w )
         loss_ = loss_ / (torch.sum(~torch.isnan(x)) / x.shape[1] )
@@ -147,10 +159,12 @@ class Model_WeightedLorenzNorm(torch.nn.Module):
     def __init__(self):
         super(Model_WeightedLorenzNorm, self).__init__()
  
-    def forward(self,x,w,eps):
+    def forward(self,x,w,eps,per_sample=False):
 
         loss_ = torch.nansum( torch.log( 1. + eps**2 * x**2 ) , dim = 3)
         loss_ = torch.nansum( loss_ , dim = 2)
+        if per_sample:
+            return _per_sample_norm(loss_, x, w)
         loss_ = torch.nansum( loss_ , dim = 0)
         loss_ = torch.nansum( loss_ * w )
         loss_ = loss_ / (torch.sum(~torch.isnan(x)) / x.shape[1] )
@@ -283,16 +297,103 @@ class Model_Var_Cost(nn.Module):
         self.normPrior = m_NormPhi
         
     def forward(self, dx, dy):
+        loss_prior, loss_obs = self.cost_terms(dx, dy)
+        return loss_prior + loss_obs
+
+    def cost_terms(self, dx, dy, per_sample=False):
+        # prior and observation terms of the variational cost (of each sample with per_sample)
+        norm_kwargs = {'per_sample': True} if per_sample else {}
+        loss_prior = self.alphaReg**2 * self.normPrior(dx,self.WReg**2,self.epsReg,**norm_kwargs)
 
-        loss = self.alphaReg**2 * self.normPrior(dx,self.WReg**2,self.epsReg)
-                
         if self.DimObs == 1 :
-            loss +=  self.alphaObs[0]**2 * self.normObs(dy,self.WObs[0,:]**2,self.epsObs[0])
+            loss_obs = self.alphaObs[0]**2 * self.normObs(dy,self.WObs[0,:]**2,self.epsObs[0],**norm_kwargs)
         else:
+            loss_obs = 0.
             for kk in range(0,self.DimObs):
-                loss +=  self.alphaObs[kk]**2 * self.normObs(dy[kk],self.WObs[kk,0:dy[kk].size(1)]**2,self.epsObs[kk])
+                loss_obs = loss_obs + self.alphaObs[kk]**2 * self.normObs(dy[kk],self.WObs[kk,0:dy[kk].size(1)]**2,self.epsObs[kk],**norm_kwargs)
 
-        return loss
+        return loss_prior, loss_obs
+
+    def sample_cost_terms(self, dx, dy):
+        # detached prior and observation terms of each sample of the batch
+        with torch.no_grad():
+            return self.cost_terms(dx, dy, per_sample=True)
+
+
+class SolverDiagnostics:
+    """
+    Optional record of the solver iterations, per phase: prior and observation terms of the variational cost,
+    gradient norm and update norm of each sample, and wall time of each iteration.
+    Values are kept detached on the device during a solver run and copied to the host once at its end (the iteration
+    times are measured with cuda events on gpu), nothing is recorded unless enabled.
+    """
+    FIELDS = ('cost_prior', 'cost_obs', 'grad_norm', 'update_norm')
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phase = 'train'
+        self.runs = {}
+        self._run = None
+        self._iteration = None
+
+    def reset(self, phase=None):
+        if phase is None:
+            self.runs = {}
+        else:
+            self.runs.pop(phase, None)
+
+    def start_run(self):
+        self._run = []
+
+    @staticmethod
+    def _clock(x):
+        if x.is_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start_iteration(self, x):
+        self._iteration = {'time': self._clock(x)}
+
+    def add(self, **values):
+        self._iteration.update({k: v.detach() for k, v in values.items()})
+
+    def end_iteration(self, x):
+        self._iteration['time'] = (self._iteration['time'], self._clock(x))
+        self._run.append(self._iteration)
+        self._iteration = None
+
+    def end_run(self):
+        """
+        Store the iterations of the run on the host: a single synchronization and device to host copy
+        """
+        run, self._run = self._run, None
+        if not run:
+            return
+        clocks = [it['time'] for it in run]
+        if isinstance(clocks[-1][1], float):
+            times = [end - start for start, end in clocks]
+        else:
+            clocks[-1][1].synchronize()
+            times = [start.elapsed_time(end) / 1e3 for start, end in clocks]
+        # n_fields x n_samples x n_iter
+        values = torch.stack([torch.stack([it[f] for it in run], dim=1) for f in self.FIELDS]).cpu().numpy()
+        self.runs.setdefault(self.phase, []).append({**dict(zip(self.FIELDS, values)), 'time': np.array(times)})
+
+    def get(self, phase='train'):
+        """
+        :return: {<field>: n_samples x n_iter array, 'time': n_runs x n_iter array} of the runs of phase
+            (runs with another number of iterations than the last one are left out)
+        """
+        runs = self.runs.get(phase, [])
+        if not runs:
+            return {}
+        n_iter = len(runs[-1]['time'])
+        runs = [r for r in runs if len(r['time']) == n_iter]
+        res = {f: np.concatenate([r[f] for r in runs]) for f in self.FIELDS}
+        res['time'] = np.stack([r['time'] for r in runs])
+        return res
 
 class CorrelateNoise(torch.nn.Module):
     def __init__(self, shape_data, dim_cn):
@@ -344,6 +445,7 @@ class Solver_Grad_4DVarNN(nn.Module):
         self.correlate_noise = CorrelateNoise(ShapeData[0], 10)
         self.regularize_variance = RegularizeVariance(ShapeData[0], 10)
         self.stochastic = stochastic
+        self.diagnostics = SolverDiagnostics()
 
         with torch.no_grad():
             self.n_grad = int(n_iter_grad)
@@ -359,11 +461,20 @@ class Solver_Grad_4DVarNN(nn.Module):
         hidden = None
         cell = None 
         normgrad_ = 0.
-        
+        diagnostics = self.diagnostics if self.diagnostics.enabled else None
+        if diagnostics is not None:
+            diagnostics.start_run()
+
         for _ in range(self.n_grad):
+            if diagnostics is not None:
+                diagnostics.start_iteration(x_k)
             x_k_plus_1, hidden, cell, normgrad_ = self.solver_step(x_k, obs, mask,hidden, cell, normgrad_)
+            if diagnostics is not None:
+                diagnostics.end_iteration(x_k_plus_1)
 
             x_k = torch.mul(x_k_plus_1,1.)
+        if diagnostics is not None:
+            diagnostics.end_run()
 
         return x_k_plus_1, hidden, cell, normgrad_
 
@@ -380,6 +491,8 @@ class Solver_Grad_4DVarNN(nn.Module):
             gW = torch.mul(self.regularize_variance(x_k),self.correlate_noise(W))
             grad = grad + gW
         x_k_plus_1 = x_k - grad
+        if self.diagnostics.enabled:
+            self.diagnostics.add(grad_norm=var_cost_grad.flatten(1).norm(dim=1), update_norm=grad.flatten(1).norm(dim=1))
         return x_k_plus_1, hidden, cell, normgrad_
 
     def var_cost(self , x, yobs, mask):
@@ -387,6 +500,9 @@ class Solver_Grad_4DVarNN(nn.Module):
         dx = x - self.phi_r(x)
         
         loss = self.model_VarCost( dx , dy )
+        if self.diagnostics.enabled:
+            cost_prior, cost_obs = self.model_VarCost.sample_cost_terms(dx, dy)
+            self.diagnostics.add(cost_prior=cost_prior, cost_obs=cost_obs)
         
         var_cost_grad = torch.autograd.grad(loss, x, create_graph=True)[0]
         return loss, var_cost_grad
@@ -1,11 +1,11 @@
 import numpy as np
-import scipy.ndimage as nd
 
 def imputing_nan(data, invalid=None):
     """
     Replace the value of invalid 'data' cells (indicated by 'invalid') 
     by the value of the nearest valid data cell
     """
+    import scipy.ndimage as nd
     if invalid is None: invalid = np.isnan(data)
     ind = nd.distance_transform_edt(invalid, return_distances=False, return_indices=True)
     return data[tuple(ind)]
@@ -0,0 +1,156 @@
+"""
+Synthetic NATL60-like dataset, a local stand-in for the GPFS data to run, benchmark and profile off-cluster.
+
+Writes the files, variables, dims and time encodings the loaders expect:
+    NATL60-CJM165_NATL_ssh_y2013.1y.nc   ground truth 'ssh' (time in seconds, no units: decoded by XrDataset)
+    NATL60-CJM165_NATL_sst_y2013.1y.nc   'sst' (same time encoding as the ground truth)
+    ssh_NATL60_swot_4nadir.nc            OI 'ssh_mod' of the 4 nadirs + SWOT observations
+    ssh_NATL60_4nadir.nc                 OI 'ssh_mod' of the 4 nadirs observations
+    dataset_nadir_0d_swot.nc             observations 'ssh_mod' along 4 nadir tracks + SWOT swaths (NaN elsewhere)
+    dataset_nadir_0d.nc                  observations 'ssh_mod' along 4 nadir tracks
+
+usage:
+    python synthetic_data.py --out_dir=data/synthetic --n_time=365 --n_lat=200 --n_lon=200
+"""
+import os
+
+import numpy as np
+import xarray as xr
+
+FILES = {
+    'gt': 'NATL60-CJM165_NATL_ssh_y2013.1y.nc',
+    'sst': 'NATL60-CJM165_NATL_sst_y2013.1y.nc',
+    'oi_swot': 'ssh_NATL60_swot_4nadir.nc',
+    'oi_nadir': 'ssh_NATL60_4nadir.nc',
+    'obs_swot': 'dataset_nadir_0d_swot.nc',
+    'obs_nadir': 'dataset_nadir_0d.nc',
+}
+
+
+def ssh_field(n_time, n_lat, n_lon, rng, slope=4., decorrelation_days=10., std=.35, mean=.3):
+    """
+    Mesoscale-like SSH: Gaussian field with a k^-slope spectrum, red in time (AR(1) on each Fourier mode)
+    and slowly propagating westward
+    """
+    ky = np.fft.fftfreq(n_lat)[:, None]
+    kx = np.fft.fftfreq(n_lon)[None, :]
+    k = np.sqrt(kx ** 2 + ky ** 2)
+    k[0, 0] = np.inf
+    amp = (k + 1. / max(n_lat, n_lon)) ** (-slope / 2)
+    amp[0, 0] = 0.
+
+    rho = np.exp(-1. / decorrelation_days)
+    drift = np.exp(2j * np.pi * kx * .5)  # ~.5 pixel/day westward propagation
+
+    def noise():
+        return amp * (rng.standard_normal((n_lat, n_lon)) + 1j * rng.standard_normal((n_lat, n_lon)))
+
+    ssh = np.empty((n_time, n_lat, n_lon), dtype=np.float32)
+    spec = noise()
+    for t in range(n_time):
+        spec = rho * spec * drift + np.sqrt(1 - rho ** 2) * noise()
+        ssh[t] = np.fft.ifft2(spec).real
+    return (ssh - ssh.mean()) / ssh.std() * std + mean
+
+
+def smooth(field, sigma_px, window_days):
+    """
+    OI-like smoothing: gaussian low-pass in space and running mean in time
+    """
+    n_lat, n_lon = field.shape[1:]
+    ky = np.fft.fftfreq(n_lat)[:, None]
+    kx = np.fft.fftfreq(n_lon)[None, :]
+    gauss = np.exp(-2 * (np.pi * sigma_px) ** 2 * (kx ** 2 + ky ** 2))
+    field = np.fft.ifft2(np.fft.fft2(field) * gauss).real
+
+    half = window_days // 2
+    padded = np.concatenate([field[:1].repeat(half, 0), field, field[-1:].repeat(half, 0)])
+    csum = np.cumsum(padded, axis=0, dtype=np.float64)
+    csum = np.concatenate([np.zeros_like(csum[:1]), csum])
+    return ((csum[2 * half + 1:] - csum[:-2 * half - 1]) / (2 * half + 1)).astype(np.float32)
+
+
+def track_masks(n_time, n_lat, n_lon, rng, n_nadir=4, swot=True, swath_px=12, gap_px=4):
+    """
+    Observation masks of satellite tracks: 1 pixel wide nadir ground tracks and SWOT-like swaths
+    (two swath_px wide bands around a gap_px nadir gap), drifting from one day to the next
+    :return: (nadir mask, nadir + swot mask) booleans
+    """
+    ii, jj = np.meshgrid(np.arange(n_lat), np.arange(n_lon), indexing='ij')
+    period = max(n_lat, n_lon)
+    slopes = rng.choice([-1., 1.], n_nadir) * rng.uniform(1.5, 3., n_nadir)
+    offsets = rng.uniform(0, period, n_nadir)
+
+    nadir = np.zeros((n_time, n_lat, n_lon), dtype=bool)
+    both = np.zeros((n_time, n_lat, n_lon), dtype=bool)
+    for t in range(n_time):
+        for s, o in zip(slopes, offsets):
+            # distance (in pixels along lon) to the track of the day
+            dist = np.abs((jj - ii / s - o - 37. * t) % period - period / 2)
+            nadir[t] |= dist < .5
+        both[t] = nadir[t]
+        if swot:
+            s, o = 3.5 * (-1) ** t, 53. * t
+            dist = np.abs((jj - ii / s - o) % period - period / 2)
+            both[t] |= (dist >= gap_px / 2) & (dist < gap_px / 2 + swath_px)
+    return nadir, both
+
+
+def generate(out_dir='data/synthetic', n_time=365, n_lat=200, n_lon=200, lat_min=33., lon_min=-65., res=.05,
+             start='2012-10-01', seed=0, swot=True):
+    """
+    :param out_dir: directory where the files are written
+    :param n_time: number of days
+    :param n_lat: number of latitudes
+    :param n_lon: number of longitudes
+    :param lat_min: first latitude of the grid
+    :param lon_min: first longitude of the grid
+    :param res: grid resolution in degrees (the lightning module assumes .05)
+    :param start: first day
+    :param seed: random seed
+    :param swot: whether to add the SWOT swaths to the *_swot observation files (the 4 nadir files are always written)
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    coords = {
+        'lat': (lat_min + res * np.arange(n_lat)).astype(np.float32),
+        'lon': (lon_min + res * np.arange(n_lon)).astype(np.float32),
+    }
+    days = np.arange(n_time, dtype=np.float64)
+    # decoded on open by xarray
+    time_days = xr.Variable(('time',), days, attrs={'units': 'days since %s' % start})
+    # raw seconds without units, XrDataset(decode=True) sets "seconds since 2012-10-01" and decodes them:
+    # counted from that origin whatever the start, to stay aligned with the OI and observations
+    offset = (np.datetime64(start, 's') - np.datetime64('2012-10-01', 's')) / np.timedelta64(1, 's')
+    time_seconds = xr.Variable(('time',), offset + days * 86400.)
+    dims = ('time', 'lat', 'lon')
+
+    print('... Generate SSH %dx%dx%d' % (n_time, n_lat, n_lon))
+    gt = ssh_field(n_time, n_lat, n_lon, rng)
+    xr.Dataset({'ssh': (dims, gt)}, coords={**coords, 'time': time_seconds}).to_netcdf(
+        os.path.join(out_dir, FILES['gt']))
+
+    print('... Generate SST')
+    lat_trend = np.linspace(4., -4., n_lat, dtype=np.float32)[None, :, None]
+    sst = 20. + lat_trend + 4. * (gt - gt.mean()) + .1 * rng.standard_normal(gt.shape).astype(np.float32)
+    xr.Dataset({'sst': (dims, sst.astype(np.float32))}, coords={**coords, 'time': time_seconds}).to_netcdf(
+        os.path.join(out_dir, FILES['sst']))
+
+    print('... Generate observations and OI')
+    nadir, nadir_swot = track_masks(n_time, n_lat, n_lon, rng, swot=swot)
+    for suffix, mask, sigma in (('nadir', nadir, 25.), ('swot', nadir_swot, 15.)):
+        obs = np.where(mask, gt, np.nan).astype(np.float32)
+        xr.Dataset({'ssh_mod': (dims, obs)}, coords={**coords, 'time': time_days}).to_netcdf(
+            os.path.join(out_dir, FILES['obs_' + suffix]))
+        oi = smooth(gt, sigma_px=sigma, window_days=7) + .01 * rng.standard_normal(gt.shape).astype(np.float32)
+        xr.Dataset({'ssh_mod': (dims, oi)}, coords={**coords, 'time': time_days}).to_netcdf(
+            os.path.join(out_dir, FILES['oi_' + suffix]))
+        print('..... %s: %.1f%% observed pixels' % (suffix, 100 * mask.mean()))
+
+    return {k: os.path.join(out_dir, f) for k, f in FILES.items()}
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(generate)